@@ -0,0 +1,144 @@
+# assets.py
+# Static files for the map page, served from static/ under a content hash
+# (/assets/<hash>/<path>) so browsers can cache them forever. Each file is
+# compressed once, with gzip and with brotli when that module is installed,
+# and the smallest encoding the client accepts is sent.
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+from flask import Blueprint, Response, abort, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('.js', '.css', '.svg', '.json', '.html', '.map')
+MIN_COMPRESS = 512 # bytes, smaller files aren't worth the header
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+blueprint = Blueprint('assets', __name__)
+
+
+def accepted_encodings(header):
+    # Accept-Encoding -> {encoding: q}, "gzip;q=0" is a refusal
+    accepted = {}
+    for token in header.split(','):
+        name, *params = token.strip().lower().split(';')
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+class Asset():
+    def __init__(self, path, data):
+        self.version = hashlib.sha1(data).hexdigest()[:10]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.encodings = {'identity': data}
+        if path.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS:
+            self.encodings['gzip'] = gzip.compress(data, 9, mtime=0)
+            if brotli is not None:
+                self.encodings['br'] = brotli.compress(data, quality=11)
+
+    def choose(self, accept_encoding):
+        # Smallest of the encodings the client takes
+        accepted = accepted_encodings(accept_encoding)
+        best = 'identity'
+        for encoding in ('gzip', 'br'):
+            if encoding in self.encodings and accepted.get(encoding, accepted.get('*', 0.0)) > 0 and \
+                    len(self.encodings[encoding]) < len(self.encodings[best]):
+                best = encoding
+        return best, self.encodings[best]
+
+
+class AssetCache():
+    def __init__(self, root=STATIC_DIR):
+        self.root = root
+        self.lock = threading.RLock() # a stylesheet loads the assets it references
+        self.assets = {}
+
+    def get(self, name):
+        asset = self.assets.get(name)
+        if asset is None:
+            path = os.path.normpath(os.path.join(self.root, name))
+            if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+                return None
+            with self.lock:
+                asset = self.assets.get(name)
+                if asset is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    if name.endswith('.css'):
+                        data = self.link_css(name, data)
+                    asset = self.assets[name] = Asset(path, data)
+        return asset
+
+    def link_css(self, name, data):
+        # Relative url(...) references become versioned asset URLs, so images a
+        # stylesheet loads are cached like the rest, and the stylesheet's own
+        # hash changes with them
+        folder = posixpath.dirname(name)
+        def versioned(match):
+            quote, target = match.group(1), match.group(2).strip()
+            if target.startswith(('data:', '#', '/')) or '://' in target:
+                return match.group(0)
+            path, sep, suffix = target.partition('?')
+            referenced = posixpath.normpath(posixpath.join(folder, path))
+            if self.get(referenced) is None:
+                return match.group(0)
+            return f"url({quote}{self.url(referenced)}{sep}{suffix}{quote})"
+        return CSS_URL.sub(versioned, data.decode('utf-8')).encode('utf-8')
+
+    def url(self, name):
+        asset = self.get(name)
+        if asset is None:
+            raise FileNotFoundError(name)
+        return f"/assets/{asset.version}/{name}"
+
+    def preload(self):
+        # Hash and compress everything up front instead of on first request
+        for folder, dirs, files in os.walk(self.root):
+            for file in files:
+                self.get(os.path.relpath(os.path.join(folder, file), self.root).replace(os.sep, '/'))
+        return self
+
+
+asset_cache = AssetCache()
+
+@blueprint.app_template_global('asset')
+def asset_url(name):
+    # {{ asset('vendor/leaflet/leaflet.js') }} in templates
+    return asset_cache.url(name)
+
+@blueprint.route('/assets/<version>/<path:name>')
+def serve_asset(version, name):
+    asset = asset_cache.get(name)
+    if asset is None:
+        abort(404)
+    encoding, data = asset.choose(request.headers.get('Accept-Encoding', ''))
+    response = Response(data, mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    if version == asset.version:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        # An old page asking for a file that changed since, don't pin this copy
+        response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{asset.version}-{encoding}")
+    return response.make_conditional(request)
@@ -0,0 +1,490 @@
+# benchmark.py
+# Telemetry path benchmarks on synthetic CRSF streams
+#   python benchmark.py                      run everything
+#   python benchmark.py crc framer --noise 0.01 --crc-errors 0.01 --bad-lengths 0.01
+#   python benchmark.py --save base.json     then later --compare base.json to catch regressions
+#   python benchmark.py http --clients 32 --server dev
+import argparse
+import http.client
+import json
+import multiprocessing
+import socket
+import threading
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import telemetry
+from shared_data import shared_data
+
+# Rough frame mix of an ELRS link at 150Hz with full telemetry
+DEFAULT_MIX = {
+    'RC_CHANNELS_PACKED': 50,
+    'LINK_STATISTICS': 15,
+    'ATTITUDE': 20,
+    'GPS': 5,
+    'BATTERY_SENSOR': 5,
+    'VARIO': 3,
+    'FLIGHT_MODE': 2,
+}
+
+def crc8_data_bitwise(data) -> int:
+    # Original per-bit implementation, kept as the reference to beat
+    crc = 0
+    for a in data:
+        crc = telemetry.crc8_dvb_s2(crc, a)
+    return crc
+
+# Encoders, the inverse of telemetry's decoders, to build the test streams
+def build_frame(ptype, payload, address=telemetry.CRSF_SYNC) -> bytes:
+    result = bytearray([address, len(payload) + 2, ptype])
+    result += payload
+    result.append(telemetry.crc8_data(result[2:]))
+    return result
+
+def encode_gps(rec):
+    return build_frame(telemetry.PacketsTypes.GPS, telemetry.GPS_STRUCT.pack(round(rec.lat * 1e7), round(rec.lon * 1e7),
+        round(rec.gspd * 36.0), round(rec.hdg * 100.0), round(rec.alt) + 1000, rec.sats))
+
+def encode_attitude(rec):
+    return build_frame(telemetry.PacketsTypes.ATTITUDE, telemetry.ATTITUDE_STRUCT.pack(round(rec.pitch * 10000.0),
+        round(rec.roll * 10000.0), round(rec.yaw * 10000.0)))
+
+def encode_battery(rec):
+    return build_frame(telemetry.PacketsTypes.BATTERY_SENSOR, telemetry.BATTERY_STRUCT.pack(round(rec.vbat * 10.0),
+        round(rec.curr * 10.0), rec.mah >> 16 & 0xFF, rec.mah & 0xFFFF, rec.pct))
+
+def encode_link_statistics(rec):
+    return build_frame(telemetry.PacketsTypes.LINK_STATISTICS, telemetry.LINK_STATISTICS_STRUCT.pack(*rec))
+
+def encode_vario(rec):
+    return build_frame(telemetry.PacketsTypes.VARIO, telemetry.VARIO_STRUCT.pack(round(rec.vspd * 10.0)))
+
+def encode_baro_alt(rec):
+    return build_frame(telemetry.PacketsTypes.BARO_ALT, telemetry.BARO_ALT_STRUCT.pack(round(rec.alt * 100.0)))
+
+def encode_flight_mode(rec):
+    return build_frame(telemetry.PacketsTypes.FLIGHT_MODE, rec.flightmode.encode('ascii') + b'\x00')
+
+def encode_rc_channels(rec):
+    return telemetry.channelsCrsfToChannelsPacket(rec.channels)
+
+ENCODERS = {
+    telemetry.GpsRecord: encode_gps,
+    telemetry.AttitudeRecord: encode_attitude,
+    telemetry.BatteryRecord: encode_battery,
+    telemetry.LinkStatsRecord: encode_link_statistics,
+    telemetry.VarioRecord: encode_vario,
+    telemetry.BaroAltRecord: encode_baro_alt,
+    telemetry.FlightModeRecord: encode_flight_mode,
+    telemetry.RcChannelsRecord: encode_rc_channels,
+}
+
+def encode_record(rec) -> bytes:
+    return ENCODERS[type(rec)](rec)
+
+def synthetic_record(ptype, i, rnd):
+    # Slowly moving, plausible values so decoded state looks like a flight
+    t = i / 150.0
+    if ptype == 'GPS':
+        return telemetry.GpsRecord(36.5298 + 0.001 * math.sin(t / 60), -83.2168 + 0.001 * math.cos(t / 60),
+                                   rnd.uniform(0, 30), rnd.uniform(0, 359.99), rnd.randint(50, 500), rnd.randint(5, 20))
+    elif ptype == 'ATTITUDE':
+        return telemetry.AttitudeRecord(0.3 * math.sin(t), 0.5 * math.cos(t), rnd.uniform(-3.14, 3.14))
+    elif ptype == 'BATTERY_SENSOR':
+        return telemetry.BatteryRecord(rnd.uniform(10.5, 12.6), rnd.uniform(0, 40), rnd.randint(0, 5000), rnd.randint(0, 100))
+    elif ptype == 'LINK_STATISTICS':
+        return telemetry.LinkStatsRecord(rnd.randint(-110, -30), rnd.randint(-110, -30), rnd.randint(0, 100), rnd.randint(-10, 10),
+                                         0, 2, 3, rnd.randint(-110, -30), rnd.randint(0, 100), rnd.randint(-10, 10))
+    elif ptype == 'VARIO':
+        return telemetry.VarioRecord(rnd.uniform(-10, 10))
+    elif ptype == 'BARO_ALT':
+        return telemetry.BaroAltRecord(rnd.uniform(0, 500))
+    elif ptype == 'FLIGHT_MODE':
+        return telemetry.FlightModeRecord(rnd.choice(["ANGL", "HOR", "ACRO", "WAIT", "RTH"]))
+    elif ptype == 'RC_CHANNELS_PACKED':
+        return telemetry.RcChannelsRecord([rnd.randint(172, 1811) for ch in range(16)])
+    raise ValueError(f"No synthetic record for {ptype}")
+
+def synthetic_frames(n, mix=DEFAULT_MIX, seed=1):
+    rnd = random.Random(seed)
+    types = list(mix)
+    weights = [mix[t] for t in types]
+    return [bytes(encode_record(synthetic_record(ptype, i, rnd)))
+            for i, ptype in enumerate(rnd.choices(types, weights, k=n))]
+
+def synthetic_stream(frames, noise=0.0, crc_errors=0.0, bad_lengths=0.0, seed=2):
+    # Joins frames into one byte stream, corrupting some of them:
+    #   noise       chance of 1-16 random bytes before a frame
+    #   crc_errors  chance of a flipped payload bit
+    #   bad_lengths chance of a random length byte
+    # Returns the stream and the number of frames left intact
+    rnd = random.Random(seed)
+    stream = bytearray()
+    intact = 0
+    for frame in frames:
+        if rnd.random() < noise:
+            stream += bytes(rnd.randrange(256) for i in range(rnd.randint(1, 16)))
+        r = rnd.random()
+        if r < crc_errors:
+            frame = bytearray(frame)
+            frame[rnd.randrange(3, len(frame) - 1)] ^= 1 << rnd.randrange(8)
+        elif r < crc_errors + bad_lengths:
+            frame = bytearray(frame)
+            frame[1] = rnd.choice([b for b in range(256) if b != frame[1]])
+        else:
+            intact += 1
+        stream += frame
+    return bytes(stream), intact
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def measure(name, func, items, unit="frame"):
+    # Runs func on every item, returns throughput, CPU per item and per call latency
+    timer = time.perf_counter_ns
+    samples = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for item in items:
+        t0 = timer()
+        func(item)
+        samples.append(timer() - t0)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    samples.sort()
+    result = {
+        'per_s': len(items) / wall,
+        'cpu_us': cpu / len(items) * 1e6,
+        'p50_us': percentile(samples, 0.50) / 1000,
+        'p99_us': percentile(samples, 0.99) / 1000,
+    }
+    report(name, result, unit)
+    return result
+
+def report(name, result, unit="frame"):
+    line = f"{name:<28} {result['per_s']:>10.0f} {unit}/s  cpu {result['cpu_us']:>7.2f} us/{unit}"
+    if 'p50_us' in result:
+        line += f"  p50 {result['p50_us']:>7.2f} us  p99 {result['p99_us']:>7.2f} us"
+    print(line)
+
+def bench_crc(args, frames):
+    results = {}
+    results['crc_bitwise'] = measure("crc8 bitwise", lambda f: crc8_data_bitwise(f[2:-1]) == f[-1], frames)
+    results['crc_table'] = measure("crc8 table", telemetry.crsf_validate_frame, frames)
+    # Whole batch in one call, no per frame latency
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    telemetry.crsf_validate_frames(frames)
+    wall = time.perf_counter() - wall_start
+    results['crc_table_batch'] = {'per_s': len(frames) / wall, 'cpu_us': (time.process_time() - cpu_start) / len(frames) * 1e6}
+    report("crc8 table batch", results['crc_table_batch'])
+    return results
+
+def bench_framer(args, frames):
+    stream, intact = synthetic_stream(frames, args.noise, args.crc_errors, args.bad_lengths)
+    # Serial reads at 420000 baud come in chunks of a few dozen to a few hundred bytes
+    rnd = random.Random(3)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rnd.randint(16, 256)
+        chunks.append(stream[pos:pos + n])
+        pos += n
+    framer = telemetry.CrsfFramer(on_error=lambda frame: None)
+    out = [0]
+    def feed(chunk):
+        for frame in framer.feed(chunk):
+            out[0] += 1
+    per_read = measure("framer (per read)", feed, chunks, unit="read")
+    # Normalise to frames so runs with different chunking compare
+    result = {
+        'per_s': per_read['per_s'] * out[0] / len(chunks),
+        'cpu_us': per_read['cpu_us'] * len(chunks) / max(out[0], 1),
+    }
+    report("framer (per frame)", result)
+    stats = framer.stats()
+    print(f"{'':<28} {out[0]}/{intact} intact frames, {stats['frames_recovered']} recovered, "
+          f"{stats['crc_errors']} crc errors, {stats['bytes_discarded']} bytes discarded")
+    return {'framer': result, 'framer_read': per_read}
+
+def bench_decode(args, frames):
+    shared_data.printtele = False
+    results = {}
+    results['decode'] = measure("decodeCrsfPacket", lambda f: telemetry.decodeCrsfPacket(f[2], f), frames)
+    results['handle'] = measure("handleCrsfPacket", lambda f: telemetry.handleCrsfPacket(f[2], f), frames)
+    return results
+
+def bench_replay(args, frames):
+    # Full path from a capture: mmap reader -> framer -> decode -> shared_data
+    from recorder import FlightRecorder
+    from replay import ReplayEngine
+    shared_data.printtele = False
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.crsf')
+        rec = FlightRecorder(path).start()
+        for i, frame in enumerate(frames):
+            rec.record(1e9 + i / 150.0, "bench", frame)
+        rec.stop()
+        engine = ReplayEngine(path, speed=0)
+        cpu_start = time.process_time()
+        engine.run()
+        result = {'per_s': engine.stats()['fps'], 'cpu_us': (time.process_time() - cpu_start) / len(frames) * 1e6}
+        engine.reader.close()
+    report("replay (as fast as possible)", result)
+    return {'replay': result}
+
+def bench_geodesic(args, frames):
+    # Scalar gps_to_vector/vector_to_gps against the batch API, per point pair
+    import numpy as np
+    import geospatial
+    n = 10000
+    rnd = np.random.default_rng(4)
+    lat1 = 36.5 + rnd.uniform(-0.05, 0.05, n)
+    lon1 = -83.2 + rnd.uniform(-0.05, 0.05, n)
+    lat2 = 36.5 + rnd.uniform(-0.05, 0.05, n)
+    lon2 = -83.2 + rnd.uniform(-0.05, 0.05, n)
+    # One pair in ten far apart, beyond FLAT_MAX_DIST, so "auto" also runs its exact fallback
+    far = rnd.random(n) < 0.1
+    lat2[far] += rnd.uniform(-1, 1, far.sum())
+    lon2[far] += rnd.uniform(-1, 1, far.sum())
+    azi = rnd.uniform(0, 360, n)
+    dist = np.where(far, rnd.uniform(10000, 100000, n), rnd.uniform(0, 5000, n))
+    a = [geospatial.GPSposition(lat, lon, 0) for lat, lon in zip(lat1, lon1)]
+    b = [geospatial.GPSposition(lat, lon, 10) for lat, lon in zip(lat2, lon2)]
+
+    def timed(name, func, count):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        func()
+        wall = time.perf_counter() - wall_start
+        result = {'per_s': count / wall, 'cpu_us': (time.process_time() - cpu_start) / count * 1e6}
+        report(name, result, unit="pair")
+        return result
+
+    results = {}
+    results['geo_inverse_scalar'] = timed("gps_to_vector (scalar)", lambda: [geospatial.gps_to_vector(p, q) for p, q in zip(a, b)], n)
+    for method in ("exact", "auto", "flat", "haversine"):
+        results[f'geo_inverse_{method}'] = timed(f"inverse_batch {method}",
+                                                 lambda: geospatial.inverse_batch(lat1, lon1, lat2, lon2, method), n)
+    results['geo_direct_scalar'] = timed("vector_to_gps (scalar)", lambda: [geospatial.vector_to_gps(p, d, z) for p, d, z in zip(a, dist, azi)], n)
+    for method in ("exact", "auto", "flat", "haversine"):
+        results[f'geo_direct_{method}'] = timed(f"direct_batch {method}",
+                                                lambda: geospatial.direct_batch(lat1, lon1, azi, dist, method), n)
+    m = 300 # N x M distance table
+    results['geo_matrix_flat'] = timed(f"inverse_matrix flat {m}x{m}",
+                                       lambda: geospatial.inverse_matrix(lat1[:m], lon1[:m], lat2[:m], lon2[:m], "flat"), m * m)
+    exact, _ = geospatial.inverse_batch(lat1, lon1, lat2, lon2, "exact")
+    for method in ("auto", "flat", "haversine"):
+        approx, _ = geospatial.inverse_batch(lat1, lon1, lat2, lon2, method)
+        near = np.abs(approx[~far] - exact[~far]).max()
+        far_error = np.abs(approx[far] - exact[far]).max()
+        print(f"{'':<28} {method} max distance error {near:.4f} m near, {far_error:.4f} m far")
+    exact_lat, exact_lon = geospatial.direct_batch(lat1, lon1, azi, dist, "exact")
+    auto_lat, auto_lon = geospatial.direct_batch(lat1, lon1, azi, dist, "auto")
+    error = geospatial.inverse_batch(auto_lat, auto_lon, exact_lat, exact_lon, "exact")[0]
+    print(f"{'':<28} direct auto max position error {error.max():.4f} m")
+    # Scalars take the same paths
+    geospatial.inverse_batch(36.5, -83.2, 37.5, -83.21)
+    geospatial.direct_batch(36.5, -83.2, 45, 50000)
+    return results
+
+def serve_map(mode, port):
+    # Map server in its own process, fed a synthetic flight: a long track and
+    # GPS updates at 50Hz, so deltas, /track tails and /stream events are live
+    import logging
+    import geospatial
+    from map_server import run_flask
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # dev server request log
+    for i in range(5000):
+        shared_data.log_pos.append(geospatial.GPSposition(36.5 + 0.01 * math.sin(i / 500), -83.2 + i * 1e-5, 100))
+    def fly():
+        i = 0
+        while True:
+            i += 1
+            shared_data.publish(got_gps=True, hdg=i % 360,
+                                pos_uav=geospatial.GPSposition(36.5 + 1e-5 * math.sin(i / 100), -83.2 + 1e-5 * i, 100))
+            time.sleep(0.02)
+    threading.Thread(target=fly, daemon=True).start()
+    run_flask(mode, '127.0.0.1', port)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def http_client(port, next_path, deadline, samples, errors):
+    # One keep-alive connection issuing requests back to back.
+    # next_path(response) gives the next URL, the way a map page would poll.
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    path = next_path(None)
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter_ns()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            conn.close()
+            continue
+        samples.append(time.perf_counter_ns() - t0)
+        path = next_path((response.status, body))
+    conn.close()
+
+def sse_client(port, deadline, counts, errors):
+    # Counts "pose" events, the first count is the time to the first event
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        t0 = time.perf_counter()
+        sock.sendall(b"GET /stream?rate=50 HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n")
+        events = 0
+        first = None
+        while time.perf_counter() < deadline:
+            data = sock.recv(65536)
+            if not data:
+                break
+            n = data.count(b"event: pose")
+            if n and first is None:
+                first = time.perf_counter() - t0
+            events += n
+        sock.close()
+        counts.append((first, events))
+    except OSError:
+        errors.append(1)
+
+def delta_poller():
+    versions = {'pose': -1, 'markers': -1}
+    def next_path(result):
+        if result and result[0] == 200:
+            data = json.loads(result[1])
+            versions['pose'] = data['pose_seq']
+            versions['markers'] = data['markers_seq']
+        return f"/update_marker?pose={versions['pose']}&markers={versions['markers']}"
+    return next_path
+
+def track_poller():
+    state = {'from': 0, 'count': -1}
+    def next_path(result):
+        if result and result[0] == 200:
+            data = json.loads(result[1])
+            state['from'] = data['finished']
+            state['count'] = data['count']
+        return f"/track?zoom=15&from={state['from']}&count={state['count']}"
+    return next_path
+
+def bench_http(args, frames):
+    # Requests/s and latency with args.clients concurrent clients per endpoint.
+    # The clients are threads of this process, with many of them the numbers
+    # are bounded by the client side as much as the server.
+    port = free_port()
+    server = multiprocessing.Process(target=serve_map, args=(args.server, port), daemon=True)
+    server.start()
+    deadline = time.perf_counter() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.perf_counter() > deadline:
+                server.terminate()
+                raise RuntimeError("map server did not start")
+            time.sleep(0.05)
+
+    endpoints = {
+        'http_update_marker': lambda: lambda result: "/update_marker",
+        'http_update_marker_delta': delta_poller,
+        'http_track': track_poller,
+    }
+    results = {}
+    try:
+        for name, poller in endpoints.items():
+            samples = []
+            errors = []
+            deadline = time.perf_counter() + args.duration
+            clients = [threading.Thread(target=http_client, args=(port, poller(), deadline, samples, errors))
+                       for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            samples.sort()
+            if not samples:
+                print(f"{name:<28} no responses, {len(errors)} errors")
+                continue
+            results[name] = {
+                'per_s': len(samples) / args.duration,
+                'p50_us': percentile(samples, 0.50) / 1000,
+                'p99_us': percentile(samples, 0.99) / 1000,
+                'errors': len(errors),
+            }
+            print(f"{name:<28} {results[name]['per_s']:>10.0f} req/s  p50 {results[name]['p50_us'] / 1000:>7.2f} ms"
+                  f"  p99 {results[name]['p99_us'] / 1000:>7.2f} ms  {len(errors)} errors")
+
+        counts = []
+        errors = []
+        deadline = time.perf_counter() + args.duration
+        clients = [threading.Thread(target=sse_client, args=(port, deadline, counts, errors)) for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        events = sum(n for first, n in counts)
+        firsts = sorted(first for first, n in counts if first is not None)
+        results['http_stream'] = {'per_s': events / args.duration, 'clients': len(counts), 'errors': len(errors)}
+        print(f"{'http_stream':<28} {events / args.duration:>10.0f} events/s  {len(counts)}/{args.clients} clients"
+              f"  first event p50 {percentile(firsts, 0.5) * 1000 if firsts else 0:.1f} ms")
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+BENCHMARKS = {
+    "crc": bench_crc,
+    "framer": bench_framer,
+    "decode": bench_decode,
+    "replay": bench_replay,
+    "http": bench_http,
+    "geodesic": bench_geodesic,
+}
+
+def compare(results, baseline, tolerance):
+    # Returns the names whose throughput dropped by more than tolerance
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['per_s'] < baseline[name]['per_s'] * (1 - tolerance):
+            print(f"REGRESSION {name}: {result['per_s']:.0f}/s vs baseline {baseline[name]['per_s']:.0f}/s")
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MinimGCS telemetry benchmarks")
+    parser.add_argument("names", nargs="*", help=f"any of {', '.join(BENCHMARKS)}, default all")
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--noise", type=float, default=0.0)
+    parser.add_argument("--crc-errors", type=float, default=0.0)
+    parser.add_argument("--bad-lengths", type=float, default=0.0)
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients for http")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per endpoint for http")
+    parser.add_argument("--server", default="waitress", help="map server mode for http: waitress or dev")
+    parser.add_argument("--save", help="write results to a JSON file")
+    parser.add_argument("--compare", help="baseline JSON from --save, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    frames = synthetic_frames(args.frames)
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results.update(BENCHMARKS[name](args, frames))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
@@ -0,0 +1,264 @@
+# geofence.py
+# Inclusion and exclusion zones (polygons and circles) checked against every
+# GPS position. Zones are compiled once into a local ENU frame and a grid of
+# square cells: each cell keeps, per zone near it, whether a reference point
+# in the cell is inside and the edges within LOOKAHEAD meters of the cell. A
+# check then only looks at one cell, so its cost depends on how many edges
+# pass near the UAV, not on how many zones or vertices there are. Compiling
+# is the slow part and is done once per edit, see GeofenceEngine.compile().
+import collections
+import itertools
+import math
+import threading
+import numpy as np
+import geospatial
+
+CELL_SIZE = 250.0 # grid cell edge in meters
+LOOKAHEAD = 200.0 # meters, boundary distances are exact up to this and capped beyond
+SHAPES = ("polygon", "circle")
+
+Zone = collections.namedtuple('Zone', ['id', 'shape', 'inclusion', 'points', 'radius', 'name'])
+# points: [(lat, lon), ...] polygon vertices, or [(lat, lon)] the circle center
+
+FenceStatus = collections.namedtuple('FenceStatus', ['breach', 'margin', 'zone'])
+# margin: meters to the nearest boundary that matters, positive on the allowed
+# side, negative in breach, capped at +-LOOKAHEAD. zone: id of that zone or None.
+NO_FENCE = FenceStatus(False, None, None)
+
+# Reference point of a cell, off center so it never falls exactly on a vertex or edge
+REFERENCE = (0.5 + 1e-3 * math.pi, 0.5 + 1e-3 * math.e)
+
+
+def check_points(points):
+    # ValueError unless every (lat, lon) is on the globe (NaN isn't)
+    for lat, lon in points:
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"Fence point {lat}, {lon} out of range")
+    return points
+
+def grid_in_polygon(gx, gy, x, y):
+    # Even-odd rule for the grid of points gx (columns) by gy (rows) against one
+    # closed ring of vertices x, y: one scanline per row, crossings to the left
+    # of each column counted with a binary search
+    x2, y2 = np.roll(x, -1), np.roll(y, -1)
+    inside = np.zeros((len(gy), len(gx)), dtype=bool)
+    for row, qy in enumerate(gy):
+        straddle = (y > qy) != (y2 > qy)
+        ax, ay, bx, by = x[straddle], y[straddle], x2[straddle], y2[straddle]
+        cross = np.sort(ax + (qy - ay) * (bx - ax) / (by - ay))
+        inside[row] = np.searchsorted(cross, gx) % 2 == 1
+    return inside
+
+def segment_distances(px, py, ax, ay, bx, by):
+    # Distance from one point to each segment a-b
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(((px - ax) * dx + (py - ay) * dy) / length2, 0.0, 1.0)
+    t = np.where(length2 > 0, t, 0.0)
+    return np.hypot(ax + t * dx - px, ay + t * dy - py)
+
+def segment_crossings(px, py, qx, qy, ax, ay, bx, by):
+    # Whether segment p-q properly crosses each segment a-b
+    d1 = (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+    d2 = (bx - ax) * (qy - ay) - (by - ay) * (qx - ax)
+    d3 = (qx - px) * (ay - py) - (qy - py) * (ax - px)
+    d4 = (qx - px) * (by - py) - (qy - py) * (bx - px)
+    return (d1 * d2 < 0) & (d3 * d4 < 0)
+
+
+class FenceCell():
+    # Everything a check needs about the zones near one cell, as arrays
+    def __init__(self, reference, zones, inside, edges, edge_slot, circles, circle_slot):
+        self.rx, self.ry = reference
+        self.zones = np.array(zones, dtype=np.intp) # slot -> index into CompiledFences.zones
+        self.inside = np.array(inside, dtype=bool) # slot -> reference point inside
+        edges = np.array(edges, dtype=float).reshape(-1, 4)
+        self.ax, self.ay, self.bx, self.by = edges.T
+        self.edge_slot = np.array(edge_slot, dtype=np.intp)
+        circles = np.array(circles, dtype=float).reshape(-1, 3)
+        self.cx, self.cy, self.cr = circles.T
+        self.circle_slot = np.array(circle_slot, dtype=np.intp)
+
+
+class CompiledFences():
+    def __init__(self, zones, frame, cell_size=CELL_SIZE, lookahead=LOOKAHEAD):
+        self.zones = zones
+        self.frame = frame
+        self.cell_size = cell_size
+        self.lookahead = lookahead
+        self.inclusion = np.array([zone.inclusion for zone in zones], dtype=bool)
+        self.has_inclusion = bool(self.inclusion.any())
+        builders = collections.defaultdict(lambda: collections.defaultdict(lambda: [False, [], None]))
+        for index, zone in enumerate(zones):
+            if zone.shape == "circle":
+                self.add_circle(builders, index, zone)
+            else:
+                self.add_polygon(builders, index, zone)
+        self.cells = {key: self.build_cell(key, slots) for key, slots in builders.items()}
+
+    def project(self, points):
+        lats = np.array([p[0] for p in points], dtype=float)
+        lons = np.array([p[1] for p in points], dtype=float)
+        east, north, up = self.frame.to_enu(lats, lons)
+        return east, north
+
+    def cell_range(self, x0, y0, x1, y1):
+        # Keys of the cells overlapping a box grown by the lookahead
+        size, pad = self.cell_size, self.lookahead
+        for cy in range(math.floor((y0 - pad) / size), math.floor((y1 + pad) / size) + 1):
+            for cx in range(math.floor((x0 - pad) / size), math.floor((x1 + pad) / size) + 1):
+                yield cx, cy
+
+    def reference(self, key):
+        return (key[0] + REFERENCE[0]) * self.cell_size, (key[1] + REFERENCE[1]) * self.cell_size
+
+    def add_circle(self, builders, index, zone):
+        (x,), (y,) = self.project(zone.points)
+        r = zone.radius
+        for key in self.cell_range(x - r, y - r, x + r, y + r):
+            rx, ry = self.reference(key)
+            slot = builders[key][index]
+            slot[0] = math.hypot(rx - x, ry - y) < r
+            slot[2] = (x, y, r)
+
+    def add_polygon(self, builders, index, zone):
+        x, y = self.project(zone.points)
+        keys = list(self.cell_range(x.min(), y.min(), x.max(), y.max()))
+        columns = sorted({key[0] for key in keys})
+        rows = sorted({key[1] for key in keys})
+        inside = grid_in_polygon(np.array([self.reference((cx, 0))[0] for cx in columns]),
+                                 np.array([self.reference((0, cy))[1] for cy in rows]), x, y)
+        for key in keys:
+            builders[key][index][0] = bool(inside[key[1] - rows[0], key[0] - columns[0]])
+        x2, y2 = np.roll(x, -1), np.roll(y, -1)
+        for edge in zip(x, y, x2, y2):
+            ax, ay, bx, by = edge
+            for key in self.cell_range(min(ax, bx), min(ay, by), max(ax, bx), max(ay, by)):
+                builders[key][index][1].append(edge)
+
+    def build_cell(self, key, slots):
+        zones, inside, edges, edge_slot, circles, circle_slot = [], [], [], [], [], []
+        for slot, (index, (slot_inside, slot_edges, circle)) in enumerate(sorted(slots.items())):
+            zones.append(index)
+            inside.append(slot_inside)
+            edges.extend(slot_edges)
+            edge_slot.extend([slot] * len(slot_edges))
+            if circle is not None:
+                circles.append(circle)
+                circle_slot.append(slot)
+        return FenceCell(self.reference(key), zones, inside, edges, edge_slot, circles, circle_slot)
+
+    def check(self, lat, lon):
+        x, y = self.frame.enu(lat, lon)[:2]
+        cell = self.cells.get((math.floor(x / self.cell_size), math.floor(y / self.cell_size)))
+        pad = self.lookahead
+        # Nothing near: outside every zone by more than the lookahead
+        margin_in, zone_in = (-pad, None) if self.has_inclusion else (pad, None)
+        margin_ex, zone_ex = pad, None
+        if cell is not None:
+            count = len(cell.zones)
+            dist = np.full(count, pad)
+            inside = cell.inside.copy()
+            if len(cell.edge_slot):
+                np.minimum.at(dist, cell.edge_slot, segment_distances(x, y, cell.ax, cell.ay, cell.bx, cell.by))
+                # Each edge crossed on the way to the reference point flips inside/outside
+                crossed = segment_crossings(x, y, cell.rx, cell.ry, cell.ax, cell.ay, cell.bx, cell.by)
+                inside ^= np.bincount(cell.edge_slot, weights=crossed, minlength=count).astype(int) % 2 == 1
+            if len(cell.circle_slot):
+                centre = np.hypot(x - cell.cx, y - cell.cy)
+                dist[cell.circle_slot] = np.minimum(np.abs(centre - cell.cr), pad)
+                inside[cell.circle_slot] = centre < cell.cr
+            inclusion = self.inclusion[cell.zones]
+            # Signed margin per zone, positive on its allowed side
+            signed = np.where(inside == inclusion, dist, -dist)
+            if inclusion.any():
+                best = np.flatnonzero(inclusion)[np.argmax(signed[inclusion])]
+                if signed[best] > margin_in:
+                    margin_in, zone_in = signed[best], best
+            if not inclusion.all():
+                worst = np.flatnonzero(~inclusion)[np.argmin(signed[~inclusion])]
+                if signed[worst] < margin_ex:
+                    margin_ex, zone_ex = signed[worst], worst
+        # Allowed inside any inclusion zone and outside all exclusion zones
+        margin, slot = (margin_in, zone_in) if margin_in < margin_ex else (margin_ex, zone_ex)
+        zone = None if slot is None else self.zones[cell.zones[slot]].id
+        margin = float(margin)
+        return FenceStatus(margin < 0, margin, zone)
+
+
+class GeofenceEngine():
+    def __init__(self, cell_size=CELL_SIZE, lookahead=LOOKAHEAD):
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.ids = itertools.count(1)
+        self.version = 0 # bumped on every change
+        self.cell_size = cell_size
+        self.lookahead = lookahead
+        self.compile_lock = threading.Lock()
+        self.compiled = None # CompiledFences of the zones at compiled_version, see compile()
+        self.compiled_version = None
+
+    def add_polygon(self, points, inclusion=False, name=""):
+        # points: [(lat, lon), ...], at least 3, the ring closes itself
+        points = check_points([(float(lat), float(lon)) for lat, lon in points])
+        if len(points) > 3 and points[0] == points[-1]:
+            points.pop()
+        if len(points) < 3:
+            raise ValueError("A fence polygon needs at least 3 vertices")
+        return self.add(Zone(None, "polygon", bool(inclusion), points, 0.0, name))
+
+    def add_circle(self, lat, lon, radius, inclusion=False, name=""):
+        points = check_points([(float(lat), float(lon))])
+        radius = float(radius)
+        if not 0 < radius < math.inf:
+            raise ValueError("A fence circle needs a positive radius")
+        return self.add(Zone(None, "circle", bool(inclusion), points, radius, name))
+
+    def add(self, zone):
+        with self.lock:
+            zone = zone._replace(id=next(self.ids))
+            self.zones[zone.id] = zone
+            self.version += 1
+            return zone
+
+    def remove(self, zone_id):
+        with self.lock:
+            zone = self.zones.pop(zone_id)
+            self.version += 1
+            return zone
+
+    def clear(self):
+        with self.lock:
+            self.zones = {}
+            self.version += 1
+
+    def compile(self):
+        # Rebuilds the grid from the current zones, in a frame of its own at the
+        # middle of them. Takes up to tenths of a second for big zones, so it is
+        # run where zones are edited (SharedData.fences_changed()), never from
+        # check(): until it has run, check() keeps using the previous zones.
+        with self.compile_lock:
+            with self.lock:
+                version = self.version
+                zones = list(self.zones.values())
+            compiled = None
+            if zones:
+                lats = [p[0] for zone in zones for p in zone.points]
+                lons = [p[1] for zone in zones for p in zone.points]
+                frame = geospatial.LocalFrame((min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2)
+                compiled = CompiledFences(zones, frame, self.cell_size, self.lookahead)
+            self.compiled, self.compiled_version = compiled, version
+            return compiled
+
+    def check(self, lat, lon):
+        # A grid lookup only, safe on the telemetry thread
+        compiled = self.compiled
+        if compiled is None:
+            return NO_FENCE
+        return compiled.check(lat, lon)
+
+    def to_dict(self):
+        with self.lock:
+            return {'version': self.version, 'lookahead': self.lookahead,
+                    'zones': [zone._asdict() for zone in self.zones.values()]}
@@ -68,11 +68,12 @@ class ArtificialHorizonIndicator(QWidget):
                 self.horizon_surface.blit(text, (center_x + 25, offset_y - 10))
 
     def update_horizon(self):
-        pitch = shared_data.pitch * -180 / math.pi
-        roll = shared_data.roll * 180 / math.pi
-        heading = shared_data.yaw * 180 / math.pi
-        speed = shared_data.gspd
-        vspd = shared_data.vspd
+        state = shared_data.snapshot()
+        pitch = state.pitch * -180 / math.pi
+        roll = state.roll * 180 / math.pi
+        heading = state.yaw * 180 / math.pi
+        speed = state.gspd
+        vspd = state.vspd
 
         self.draw_horizon(pitch, roll)
         self.draw_aircraft_symbol()
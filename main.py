@@ -7,13 +7,14 @@ from PyQt5.QtWebEngineWidgets import QWebEngineView
 from PyQt5.QtCore import Qt, QTimer, pyqtSlot,  QUrl, pyqtSignal, QObject
 from shared_data import shared_data
 from telemetry import start_data_thread
+from telelog import telemetry_log
 from user_input import keyPressEvent
 from instruments import ArtificialHorizonIndicator
 from settings import ConnectionDialog
 from video import ClickableLabel, setup_video_stream
-from map_server import run_flask, update_position, get_position
+from map_server import start_map_server, update_position, get_position, set_user_marker
+from terrain import get_terrain
 import argparse
-import threading
 import cv2
 import math
 import requests
@@ -36,10 +37,12 @@ class App(QWidget):
         self.flight_data_container_widget = None
         self.terminal_container_widget = None
         self.zoom_factor = 1.0
+        self.last_shown_telemetry = 0
         self.warnstyle_off = "background-color: black; color: white; font-size: 20px; border: 3px white; font-weight: bold;"
         self.warnstyle_on = "background-color: red; color: black; font-size: 20px; border-width: 2px; border-color: black; font-weight: bold;"
 
         self.initUI()
+        self.setup_subscriptions()
 
     def initUI(self):
         self.setWindowTitle('MinimGCS')
@@ -79,7 +82,15 @@ class App(QWidget):
         self.left_column_splitter.setStyleSheet("QSplitter::handle { background-color: grey; }")
 
         self.map_view = QWebEngineView()
-        self.map_view.setUrl(QUrl('http://localhost:5000/'))
+        self.map_bridge = None
+        if shared_data.map_bridge:
+            try:
+                from map_bridge import MapBridge
+                self.map_bridge = MapBridge(self.map_view.page(), self)
+                self.map_bridge.clicked.connect(self.map_clicked)
+            except (ImportError, RuntimeError) as e:
+                print(f"Map bridge unavailable, the map updates over HTTP: {e}")
+        self.map_view.setUrl(QUrl(f'http://localhost:{shared_data.map_server_port}/'))
         self.left_column_splitter.addWidget(self.map_view)
 
         map_info_widget = self.setup_map_info()
@@ -95,16 +106,22 @@ class App(QWidget):
 
         self.distance_to_home_label = QLabel("Distance to home: 0", self)
         self.distance_to_marker_label = QLabel("Distance to marker: 0", self)
+        self.distance_to_poi_label = QLabel("POI: -", self)
+        self.distance_to_wp_label = QLabel("WP: -", self)
         self.gps_label = QLabel("GPS: 0,0", self)
-        #self.mgrs_label = QLabel("MGRS: 0", self)
+        self.mgrs_label = QLabel("MGRS: -", self)
 
         map_info_layout.addWidget(self.distance_to_home_label)
         map_info_layout.addSpacing(10)  # Fixed distance between labels
         map_info_layout.addWidget(self.distance_to_marker_label)
         map_info_layout.addSpacing(10)  # Fixed distance between labels
+        map_info_layout.addWidget(self.distance_to_poi_label)
+        map_info_layout.addSpacing(10)  # Fixed distance between labels
+        map_info_layout.addWidget(self.distance_to_wp_label)
+        map_info_layout.addSpacing(10)  # Fixed distance between labels
         map_info_layout.addWidget(self.gps_label)
-        #map_info_layout.addSpacing(10)  # Fixed distance between labels
-        #map_info_layout.addWidget(self.mgrs_label)
+        map_info_layout.addSpacing(10)  # Fixed distance between labels
+        map_info_layout.addWidget(self.mgrs_label)
 
         map_info_widget = QWidget()
         map_info_widget.setLayout(map_info_layout)
@@ -230,6 +247,7 @@ class App(QWidget):
         flight_data_layout = QVBoxLayout()
         self.speed_label = QLabel("Speed: 0")
         self.altitude_label = QLabel("Altitude: 0")
+        self.agl_label = QLabel("AGL: -")
         self.pitch_label = QLabel("Pitch: 0")
         self.roll_label = QLabel("Roll: 0")
         self.yaw_label = QLabel("Yaw: 0")
@@ -244,6 +262,7 @@ class App(QWidget):
         self.tt_label = QLabel("TELE sec: 0")
         flight_data_layout.addWidget(self.speed_label)
         flight_data_layout.addWidget(self.altitude_label)
+        flight_data_layout.addWidget(self.agl_label)
         flight_data_layout.addWidget(self.pitch_label)
         flight_data_layout.addWidget(self.roll_label)
         flight_data_layout.addWidget(self.yaw_label)
@@ -287,19 +306,24 @@ class App(QWidget):
         self.warn_ind_tele = QLabel("TELE")
         self.warn_ind_sensor = QLabel("SENSOR")
         self.warn_ind_gps = QLabel("GPS")
+        self.warn_ind_fence = QLabel("FENCE")
 
         self.warn_ind_tele.setStyleSheet(self.warnstyle_off)
         self.warn_ind_sensor.setStyleSheet(self.warnstyle_off)
         self.warn_ind_gps.setStyleSheet(self.warnstyle_off)
+        self.warn_ind_fence.setStyleSheet(self.warnstyle_off)
         self.warn_ind_tele.setAlignment(Qt.AlignCenter)
         self.warn_ind_sensor.setAlignment(Qt.AlignCenter)
         self.warn_ind_gps.setAlignment(Qt.AlignCenter)
+        self.warn_ind_fence.setAlignment(Qt.AlignCenter)
         
         warning_panel2.addWidget(self.warn_ind_tele)
         warning_panel2.addSpacing(10)
         warning_panel2.addWidget(self.warn_ind_sensor)
         warning_panel2.addSpacing(10)
         warning_panel2.addWidget(self.warn_ind_gps)
+        warning_panel2.addSpacing(10)
+        warning_panel2.addWidget(self.warn_ind_fence)
 
         # Add both rows to the main panel
         main_panel.addLayout(warning_panel1)
@@ -332,6 +356,7 @@ class App(QWidget):
         terminal_layout = QVBoxLayout()
         self.terminal_output = QTextEdit()
         self.terminal_output.setReadOnly(True)
+        self.terminal_output.document().setMaximumBlockCount(2000)
         self.terminal_output.setStyleSheet("background-color: black; color: white;")
         terminal_layout.addWidget(self.terminal_output)
 
@@ -395,6 +420,7 @@ class App(QWidget):
 
     def toggle_video_trackzoom(self):
         shared_data.video_track_zoom_active = not shared_data.video_track_zoom_active
+        self.update_button_color()
 
     def toggle_video_maximization(self):
         if self.is_video_maximized:
@@ -415,24 +441,36 @@ class App(QWidget):
 
     def map_view_lock(self):
         shared_data.map_center = not shared_data.map_center
+        shared_data.markers_changed()
+        self.update_button_color()
 
     def marker_set_goto(self):
         shared_data.pos_goto = geospatial.GPSposition(shared_data.pos_marker.lat,shared_data.pos_marker.lon,0)
         shared_data.goto_set = True
         shared_data.user_marker_active = False
+        shared_data.markers_changed()
 
     def marker_set_poi(self):
         shared_data.pos_poi = geospatial.GPSposition(shared_data.pos_marker.lat,shared_data.pos_marker.lon,0)
         shared_data.poi_set = True
         shared_data.user_marker_active = False
+        shared_data.markers_changed()
+        self.update_map_info()
 
     def marker_set_home(self):
         shared_data.pos_home = geospatial.GPSposition(shared_data.pos_marker.lat,shared_data.pos_marker.lon,0)
         shared_data.home_set = True
         shared_data.user_marker_active = False
+        shared_data.markers_changed()
+        self.update_map_info()
 
     def remove_user_marker(self):
         shared_data.user_marker_active = False
+        shared_data.markers_changed()
+
+    def map_clicked(self, lat, lon):
+        # Click on the map page, through the bridge instead of /set_position
+        set_user_marker(lat, lon)
 
     def show_file_dialog(self):
         dialog = QDialog(self)
@@ -469,24 +507,62 @@ class App(QWidget):
     def process_command(self):
         command = self.terminal_input.text()
         self.terminal_output.append(f'Command: {command}')
+        if command == 'latency':
+            lat = shared_data.display_latency.report()
+            self.terminal_output.append(f"Frame to display latency: n={lat['count']} p50={lat['p50_ms']:.1f}ms p99={lat['p99_ms']:.1f}ms max={lat['max_ms']:.1f}ms")
         self.terminal_input.clear()
 
     def closeEvent(self, event):
+        # Flush the flight recorder before /shutdown ends the process
+        if shared_data.recorder is not None:
+            shared_data.recorder.stop()
         try:
-            requests.post('http://localhost:5000/shutdown')
+            requests.post(f'http://localhost:{shared_data.map_server_port}/shutdown')
         except requests.exceptions.RequestException as e:
             print(f"Error sending shutdown request: {e}")
         self.cap.release()
         event.accept()
 
     def setup_timers(self):
+        # Telemetry age and loss only change with time, everything else is pushed by the bus
         self.update_timer = QTimer(self)
-        self.update_timer.timeout.connect(self.update_flight_data)
-        self.update_timer.start(100)
-
-        self.timer2 = QTimer(self)
-        self.timer2.timeout.connect(self.update_button_color)
-        self.timer2.start(100)
+        self.update_timer.timeout.connect(self.update_status)
+        self.update_timer.start(500)
+
+        # Telemetry log lines reach the terminal in batches, not one append per frame
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.update_terminal_log)
+        self.log_timer.start(250)
+
+    def setup_subscriptions(self):
+        self.ui_poster = UiPoster()
+        bus = shared_data.bus
+        bus.subscribe('attitude', self.update_attitude, max_rate=30, poster=self.ui_poster)
+        bus.subscribe(('attitude', 'gps', 'vario'), self.update_pfd, max_rate=30, poster=self.ui_poster)
+        bus.subscribe('gps', self.update_gps, max_rate=10, poster=self.ui_poster)
+        bus.subscribe('battery', self.update_battery, max_rate=5, poster=self.ui_poster)
+        bus.subscribe('link', self.update_link, max_rate=5, poster=self.ui_poster)
+        bus.subscribe('flight_mode', lambda state: self.update_status(), poster=self.ui_poster)
+        bus.subscribe('fence', self.update_fence, max_rate=10, poster=self.ui_poster)
+        if self.map_bridge is not None:
+            self.map_bridge.subscribe(self.ui_poster)
+        self.refresh_all()
+
+    def refresh_all(self):
+        state = shared_data.snapshot()
+        self.update_attitude(state)
+        self.update_pfd(state)
+        self.update_gps(state)
+        self.update_battery(state)
+        self.update_link(state)
+        self.update_fence(state)
+        self.update_status()
+        self.update_button_color()
+
+    def update_terminal_log(self):
+        lines = telemetry_log.take_lines()
+        if lines:
+            self.terminal_output.append('\n'.join(lines))
 
     def update_button_color(self):
         if shared_data.video_track_zoom_active:
@@ -499,80 +575,93 @@ class App(QWidget):
         else:
             self.btn_view_lock.setStyleSheet('')
 
-        if shared_data.map_center:
-            self.btn_view_lock.setStyleSheet('background-color: red')
-        else:
-            self.btn_view_lock.setStyleSheet('')
-
     def play_alarm(self):
         pass
 
-    @pyqtSlot()
-    def update_flight_data(self):
-        vbat = shared_data.vbat
-        cellv = vbat/shared_data.scells
-        gps = shared_data.pos_uav
-        lq = shared_data.lq
-
-        # Set pfd info
-        self.speed_label.setText(f"Speed: {shared_data.gspd:.2f}")
-        self.altitude_label.setText(f"Altitude: {shared_data.pos_uav.alt:.2f}")
-        self.pitch_label.setText(f"Pitch: {math.degrees(shared_data.pitch):.2f}")
-        self.roll_label.setText(f"Roll: {math.degrees(shared_data.roll):.2f}")
-        self.yaw_label.setText(f"Yaw: {shared_data.yaw:.2f}")
-        self.hdg_label.setText(f"Heading: {shared_data.hdg:.2f}")
-        self.rssi_label.setText(f"RSSI: {shared_data.rssi1:.2f}")
-        self.lq_label.setText(f"LQ: {lq}")
-        self.sats_label.setText(f"Sats: {shared_data.sats}")
-        self.vbat_label.setText(f"VBAT: {vbat:.2f}")
-        self.cur_label.setText(f"CUR: {shared_data.curr}")
-        self.pct_label.setText(f"BAT %: {shared_data.pct}")
-        self.mah_label.setText(f"BAT mAh: {shared_data.mah}")
-        self.tt_label.setText(f"TELE sec: {round(time.time() - shared_data.last_time_telemetry,1)}")
+    def mark_displayed(self, state):
+        if state.last_time_telemetry != self.last_shown_telemetry:
+            self.last_shown_telemetry = state.last_time_telemetry
+            shared_data.display_latency.add(time.time() - self.last_shown_telemetry)
 
-        self.horizon_indicator.update_horizon()
+    def update_attitude(self, state):
+        self.mark_displayed(state)
+        self.pitch_label.setText(f"Pitch: {math.degrees(state.pitch):.2f}")
+        self.roll_label.setText(f"Roll: {math.degrees(state.roll):.2f}")
+        self.yaw_label.setText(f"Yaw: {state.yaw:.2f}")
 
-        # set map info
-        try:
-            vechome = geospatial.gps_to_vector(gps, shared_data.pos_home)
-        except:
-            vechome = geospatial.PosVector(0,0,0)
-        try:
-            vecmarker = geospatial.gps_to_vector(gps, shared_data.pos_marker)
-        except:
-            vecmarker = geospatial.PosVector(0,0,0)
+    def update_pfd(self, state):
+        self.horizon_indicator.update_horizon()
 
-        self.distance_to_home_label.setText(f"Home: {round(vechome.dist)} m")
-        self.distance_to_marker_label.setText(f"Marker: {round(vecmarker.dist)} m")
+    def update_gps(self, state):
+        self.mark_displayed(state)
+        gps = state.pos_uav
+        self.speed_label.setText(f"Speed: {state.gspd:.2f}")
+        self.altitude_label.setText(f"Altitude: {gps.alt:.2f}")
+        agl = get_terrain().agl(gps) # None without elevation tiles for the area
+        self.agl_label.setText("AGL: -" if agl is None else f"AGL: {agl:.2f}")
+        self.hdg_label.setText(f"Heading: {state.hdg:.2f}")
+        self.sats_label.setText(f"Sats: {state.sats}")
+        self.update_map_info(state)
+
+    def update_map_info(self, state=None):
+        # Also called when home or the marker move
+        state = state or shared_data.snapshot()
+        gps = state.pos_uav
+        frame = shared_data.local_frame(gps)
+        self.distance_to_home_label.setText(self.vector_text("Home", frame, gps, shared_data.pos_home, shared_data.home_set))
+        self.distance_to_marker_label.setText(self.vector_text("Marker", frame, gps, shared_data.pos_marker, shared_data.user_marker_active))
+        self.distance_to_poi_label.setText(self.vector_text("POI", frame, gps, shared_data.pos_poi, shared_data.poi_set))
+        self.update_next_waypoint(gps)
         self.gps_label.setText(f"GPS: {gps.lat:.8f}, {gps.lon:.8f}")
-
-        # set status info
-        if (time.time() - shared_data.last_time_telemetry) > 3:
-            shared_data.telemetry_lost = True
+        self.mgrs_label.setText(f"MGRS: {geospatial.mgrs_or(gps.lat, gps.lon, '—') if state.got_gps else '—'}")
+
+    def vector_text(self, name, frame, gps, target, active):
+        # Distance, bearing and elevation angle from the UAV in the cached local frame
+        if not active or frame is None:
+            return f"{name}: -"
+        vec = frame.vector(gps, target)
+        return f"{name}: {round(vec.dist)} m {round(vec.az)}° {vec.elev:+.0f}° {geospatial.mgrs_or(target.lat, target.lon, '—')}"
+
+    def update_next_waypoint(self, gps):
+        mission = shared_data.mission
+        number, wp, dist, brg = mission.distance_to_next(gps.lat, gps.lon)
+        if wp is not None and dist < shared_data.wp_accept_radius:
+            # Reached, follow on to the next one
+            mission.set_next(number + 1)
+            shared_data.markers_changed()
+            number, wp, dist, brg = mission.distance_to_next(gps.lat, gps.lon)
+        if wp is None:
+            self.distance_to_wp_label.setText("WP: -")
         else:
-            shared_data.telemetry_lost = False
+            self.distance_to_wp_label.setText(f"WP {number + 1}: {round(dist)} m {round(brg)}°")
 
-        if shared_data.error or shared_data.telemetry_lost:
-            self.status_mode.setText("TELEMETRY LOST")
-            self.status_mode.setStyleSheet(self.warnstyle_on)
-        else:
-            self.status_mode.setText(f"MODE {shared_data.flightmode}")
-            self.status_mode.setStyleSheet(self.warnstyle_off)
+    def update_battery(self, state):
+        self.mark_displayed(state)
+        vbat = state.vbat
+        cellv = vbat/shared_data.scells
+        self.vbat_label.setText(f"VBAT: {vbat:.2f}")
+        self.cur_label.setText(f"CUR: {state.curr}")
+        self.pct_label.setText(f"BAT %: {state.pct}")
+        self.mah_label.setText(f"BAT mAh: {state.mah}")
 
-        # set critical info
         self.ci_vbat_label.setText(f"BAT {vbat:.2f} V")
         self.ci_vcell_label.setText(f"CELL {cellv:.2f} V")
-        self.ci_rssi_label.setText(f"RSSI {shared_data.rssi1:.1f}")
-        self.ci_lq_label.setText(f"LQ {lq}")
-
-        if shared_data.vbat <= shared_data.warn_vbat: 
+        if vbat <= shared_data.warn_vbat: 
             self.ci_vbat_label.setStyleSheet(self.warnstyle_on)
             self.ci_vcell_label.setStyleSheet(self.warnstyle_on)
         else:
             self.ci_vbat_label.setStyleSheet(self.warnstyle_off)
             self.ci_vcell_label.setStyleSheet(self.warnstyle_off)
-        
-        if shared_data.rssi1 < shared_data.warn_rssi:
+
+    def update_link(self, state):
+        self.mark_displayed(state)
+        lq = state.lq
+        self.rssi_label.setText(f"RSSI: {state.rssi1:.2f}")
+        self.lq_label.setText(f"LQ: {lq}")
+
+        self.ci_rssi_label.setText(f"RSSI {state.rssi1:.1f}")
+        self.ci_lq_label.setText(f"LQ {lq}")
+        if state.rssi1 < shared_data.warn_rssi:
             self.ci_rssi_label.setStyleSheet(self.warnstyle_on)
         else:
             self.ci_rssi_label.setStyleSheet(self.warnstyle_off)
@@ -582,14 +671,59 @@ class App(QWidget):
         else:
             self.ci_lq_label.setStyleSheet(self.warnstyle_off)
 
+    def update_fence(self, state):
+        # Margin to the nearest fence boundary, shown once it is under warn_fence
+        fence = state.fence
+        if fence.margin is not None and fence.margin < shared_data.warn_fence:
+            self.warn_ind_fence.setText(f"FENCE {fence.margin:.0f} m")
+            self.warn_ind_fence.setStyleSheet(self.warnstyle_on)
+        else:
+            self.warn_ind_fence.setText("FENCE")
+            self.warn_ind_fence.setStyleSheet(self.warnstyle_off)
+
+    @pyqtSlot()
+    def update_status(self):
+        state = shared_data.snapshot()
+        self.tt_label.setText(f"TELE sec: {round(time.time() - state.last_time_telemetry,1)}")
+
+        # set status info
+        if (time.time() - state.last_time_telemetry) > 3:
+            shared_data.telemetry_lost = True
+        else:
+            shared_data.telemetry_lost = False
+
+        if shared_data.error or shared_data.telemetry_lost:
+            self.status_mode.setText("TELEMETRY LOST")
+            self.status_mode.setStyleSheet(self.warnstyle_on)
+        else:
+            self.status_mode.setText(f"MODE {state.flightmode}")
+            self.status_mode.setStyleSheet(self.warnstyle_off)
 
         # Warning indicators
 
 
+class UiPoster(QObject):
+    # Poster for shared_data.bus subscriptions: the signal is emitted from the
+    # telemetry threads and queued, so callbacks always run on the Qt thread
+    posted = pyqtSignal(object, float)
+
+    def __init__(self):
+        super().__init__()
+        self.posted.connect(self.run)
+
+    def __call__(self, func, delay):
+        self.posted.emit(func, delay)
+
+    @pyqtSlot(object, float)
+    def run(self, func, delay):
+        if delay > 0:
+            QTimer.singleShot(int(delay * 1000), func)
+        else:
+            func()
+
+
 if __name__ == '__main__':
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
-    time.sleep(1)
+    start_map_server()
 
     app = QApplication(['', '--no-sandbox'])
     ex = App()
@@ -0,0 +1,80 @@
+# map_bridge.py
+# QWebChannel link between the Qt app and the map page in its QWebEngineView.
+# Pose and marker updates are pushed straight into the page's JavaScript and
+# map clicks come back as a Qt signal, no HTTP round trip and no polling.
+# Flask still serves the page itself, tiles and /track, and everything for
+# external viewers.
+from PyQt5.QtCore import QObject, QFile, QIODevice, pyqtSignal, pyqtSlot
+from PyQt5.QtWebChannel import QWebChannel
+from PyQt5.QtWebEngineWidgets import QWebEngineScript
+from shared_data import shared_data
+from map_server import pose_fields, marker_fields, VehicleDeltas
+
+
+class MapBridge(QObject):
+    # Registered in the page as channel.objects.gcs
+    pose = pyqtSignal('QVariantMap')
+    markers = pyqtSignal('QVariantMap')
+    vehicles = pyqtSignal('QVariantMap') # same batches as the "vehicles" event of /stream
+    clicked = pyqtSignal(float, float) # lat, lon of a click on the map
+
+    def __init__(self, page, parent=None):
+        super().__init__(parent)
+        self.page = page
+        self.channel = QWebChannel(page)
+        self.channel.registerObject('gcs', self)
+        page.setWebChannel(self.channel)
+        self.inject_qwebchannel_js()
+        self.subscriptions = []
+        self.vehicle_deltas = VehicleDeltas()
+
+    def inject_qwebchannel_js(self):
+        # The page comes from http://localhost, which can't load qrc:/ scripts itself
+        source = QFile(':/qtwebchannel/qwebchannel.js')
+        if not source.open(QIODevice.ReadOnly):
+            raise RuntimeError("qwebchannel.js not found in the Qt resources")
+        script = QWebEngineScript()
+        script.setName('qwebchannel')
+        script.setSourceCode(bytes(source.readAll()).decode())
+        script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+        script.setWorldId(QWebEngineScript.MainWorld)
+        script.setRunsOnSubFrames(False)
+        source.close()
+        self.page.scripts().insert(script)
+
+    def subscribe(self, poster):
+        # poster runs the deliveries on the Qt thread, see main.UiPoster
+        bus = shared_data.bus
+        self.subscriptions = [
+            bus.subscribe('gps', self.push_pose, max_rate=shared_data.map_push_rate, poster=poster),
+            bus.subscribe('markers', lambda state: self.push_markers(), poster=poster),
+            bus.subscribe('vehicles', lambda state: self.push_vehicles(), max_rate=shared_data.map_push_rate, poster=poster),
+        ]
+
+    def unsubscribe(self):
+        for sub in self.subscriptions:
+            shared_data.bus.unsubscribe(sub)
+        self.subscriptions = []
+
+    def push_pose(self, state):
+        self.pose.emit(pose_fields(state))
+
+    def push_markers(self):
+        self.markers.emit(marker_fields())
+
+    def push_vehicles(self):
+        changed = self.vehicle_deltas.batch()
+        if changed:
+            self.vehicles.emit({'active': shared_data.active_vehicle, 'vehicles': changed})
+
+    @pyqtSlot()
+    def pageReady(self):
+        # Called by the page once the channel is up, also after a reload
+        self.vehicle_deltas = VehicleDeltas()
+        self.push_markers()
+        self.push_pose(shared_data.snapshot())
+        self.push_vehicles()
+
+    @pyqtSlot(float, float)
+    def mapClicked(self, lat, lon):
+        self.clicked.emit(lat, lon)
@@ -1,20 +1,23 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response
 from flask_cors import CORS
-import threading, os
-from shared_data import shared_data
+import threading, os, json, math, queue, time
+from shared_data import shared_data, DEFAULT_VEHICLE
+import geospatial
+from track import FlightTrack
+from tiles import get_tile_cache, valid_tile
+from terrain import get_terrain
+import assets
 
 app = Flask(__name__)
 CORS(app)
+app.register_blueprint(assets.blueprint)
 
 def update_position(lat, lon, alt):
-    with shared_data.lock:
-        shared_data.pos_uav.lat = lat
-        shared_data.pos_uav.lon = lon
-        shared_data.pos_uav.alt = alt
+    shared_data.publish(pos_uav=geospatial.GPSposition(lat, lon, alt))
 
 def get_position():
-    with shared_data.lock:
-        return shared_data.pos_uav.lat, shared_data.pos_uav.lon
+    pos = shared_data.snapshot().pos_uav
+    return pos.lat, pos.lon
 
 def set_user_marker(lat, lon):
     with shared_data.lock:
@@ -22,28 +25,33 @@ def set_user_marker(lat, lon):
         shared_data.pos_marker.lon = lon
         shared_data.user_marker_active = True
         print("User point:", lat, lon)
+    shared_data.markers_changed()
 
 def get_user_marker():
     with shared_data.lock:
         return shared_data.pos_marker.lat, shared_data.pos_marker.lon, shared_data.user_marker_active
 
-@app.route('/')
-def index():
-    lat, lon = get_position()
-    return render_template('map.html', latitude=lat, longitude=lon)
+def remove_user_marker():
+    with shared_data.lock:
+        shared_data.user_marker_active = False
+    shared_data.markers_changed()
 
-@app.route('/update_marker')
-def update_marker():
-    lat, lon = get_position()
+def pose_fields(state):
+    return {
+        'latitude': state.pos_uav.lat,
+        'longitude': state.pos_uav.lon,
+        'yaw': state.hdg,
+        'got_gps': state.got_gps,
+        'fence_breach': state.fence.breach,
+        'fence_zone': state.fence.zone if state.fence.breach else None,
+    }
+
+def marker_fields():
     user_lat, user_lon, user_active = get_user_marker()
-    response = {
-        'latitude': lat,
-        'longitude': lon,
-        'yaw': shared_data.hdg,
+    return {
         'user_latitude': user_lat,
         'user_longitude': user_lon,
         'user_active': user_active,
-        'got_gps': shared_data.got_gps,
         'map_center': shared_data.map_center,
         'home_set': shared_data.home_set,
         'home_lat': shared_data.pos_home.lat,
@@ -56,9 +64,450 @@ def update_marker():
         'poi_lon': shared_data.pos_poi.lon,
         'wp_set': shared_data.wp_set,
         'wp_lat': shared_data.pos_wp.lat,
-        'wp_lon': shared_data.pos_wp.lon
+        'wp_lon': shared_data.pos_wp.lon,
+        'mission_version': shared_data.mission.version,
+        'fence_version': shared_data.geofence.version,
     }
-    return jsonify(response)
+
+@app.route('/')
+def index():
+    lat, lon = get_position()
+    return render_template('map.html', latitude=lat, longitude=lon)
+
+class VersionedFields():
+    # Remembers the version at which each field last changed, so a client
+    # holding version v only needs the fields changed after v
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = -1 # newest source version folded in
+        self.version = 0 # version of the newest actual change
+        self.values = {}
+        self.changed = {}
+
+    def update(self, version, fields_func):
+        # fields_func is only called when the source version moved
+        if version <= self.checked:
+            return
+        with self.lock:
+            if version <= self.checked:
+                return
+            for name, value in fields_func().items():
+                if name not in self.values or self.values[name] != value:
+                    self.values[name] = value
+                    self.changed[name] = version
+                    self.version = version
+            self.checked = version
+
+    def delta(self, since):
+        # A client ahead of us (server restarted) gets everything
+        with self.lock:
+            if since > self.version:
+                since = -1
+            return {name: self.values[name] for name, version in self.changed.items() if version > since}
+
+pose_cache = VersionedFields() # versioned by telemetry state seq
+marker_cache = VersionedFields() # versioned by shared_data.markers_version
+
+def client_versions():
+    # ?pose=N&markers=M, or the ETag "N.M" of a previous response in If-None-Match
+    pose = request.args.get('pose', type=int)
+    markers = request.args.get('markers', type=int)
+    if pose is None and markers is None:
+        for etag in request.if_none_match.as_set():
+            try:
+                pose, markers = (int(v) for v in etag.split('.'))
+            except ValueError:
+                continue
+            break
+    return (-1 if pose is None else pose), (-1 if markers is None else markers)
+
+@app.route('/update_marker')
+def update_marker():
+    # Without versions this returns every field, as before. With them only the
+    # fields changed since, or 304 when nothing changed.
+    state = shared_data.snapshot()
+    pose_cache.update(state.seq, lambda: pose_fields(state))
+    marker_cache.update(shared_data.markers_version, marker_fields)
+    pose_since, markers_since = client_versions()
+    etag = f"{pose_cache.version}.{marker_cache.version}"
+    if pose_since == pose_cache.version and markers_since == marker_cache.version:
+        response = Response(status=304)
+    else:
+        data = pose_cache.delta(pose_since)
+        data.update(marker_cache.delta(markers_since))
+        data['pose_seq'] = pose_cache.version
+        data['markers_seq'] = marker_cache.version
+        response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+flight_tracks = {} # vehicle id -> FlightTrack
+
+def flight_track(vehicle):
+    track = flight_tracks.get(vehicle)
+    if track is None:
+        track = flight_tracks.setdefault(vehicle, FlightTrack())
+    track.sync(shared_data.track_of(vehicle))
+    return track
+
+def viewport():
+    # ?bbox=west,south,east,north as Leaflet's getBounds().toBBoxString() gives it
+    bbox = request.args.get('bbox')
+    if not bbox:
+        return None
+    try:
+        west, south, east, north = (float(v) for v in bbox.split(','))
+    except ValueError:
+        return None
+    return west, south, east, north
+
+@app.route('/track')
+def track():
+    # Flight path simplified for ?zoom=, chunks outside ?bbox= come back empty.
+    # ?from=K skips chunks the client already holds (below the "finished" of an
+    # earlier response), ?count=N gets a 304 while no new point arrived.
+    # The track is the active vehicle's, ?vehicle= is the one the client holds,
+    # when that isn't the active one any more it gets the whole track.
+    vehicle = shared_data.active_vehicle or DEFAULT_VEHICLE
+    track = flight_track(vehicle)
+    first = request.args.get('from', default=0, type=int)
+    count = request.args.get('count', type=int)
+    if request.args.get('vehicle', vehicle) != vehicle:
+        first = 0
+        count = None
+    if count == track.count:
+        return Response(status=304, headers={'Cache-Control': 'no-cache'})
+    data = track.query(request.args.get('zoom', default=13, type=int), viewport(), first)
+    data['vehicle'] = vehicle
+    response = jsonify(data)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def vehicle_fields(vehicle, state):
+    # Compact per vehicle entry of the batched "vehicles" update
+    pos = state.pos_uav
+    return [vehicle, pos.lat, pos.lon, state.hdg, pos.alt, state.last_time_telemetry]
+
+class VehicleDeltas():
+    # Picks the vehicles changed since the last batch sent to one client
+    def __init__(self):
+        self.sent = {}
+
+    def batch(self, skip_active=True):
+        active = shared_data.active_vehicle
+        changed = []
+        for vehicle, state in list(shared_data.vehicles.items()):
+            if skip_active and vehicle == active:
+                continue # drawn from "pose"
+            if self.sent.get(vehicle) != state.seq:
+                self.sent[vehicle] = state.seq
+                changed.append(vehicle_fields(vehicle, state))
+        return changed
+
+@app.route('/vehicles')
+def vehicles():
+    # Every vehicle, or with ?since=N only those whose state seq is above N
+    since = request.args.get('since', default=-1, type=int)
+    states = list(shared_data.vehicles.items())
+    return jsonify({
+        'active': shared_data.active_vehicle,
+        'seq': max((state.seq for vehicle, state in states), default=0),
+        'vehicles': [vehicle_fields(vehicle, state) for vehicle, state in states if state.seq > since],
+    })
+
+@app.route('/select_vehicle', methods=['POST'])
+def select_vehicle():
+    try:
+        shared_data.select_vehicle(request.json['vehicle'])
+    except KeyError:
+        return jsonify({'status': 'unknown vehicle'}), 404
+    return jsonify({'status': 'success'})
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/stream')
+def stream():
+    # Server-Sent Events: "pose" whenever the active vehicle moves, "markers" when
+    # markers change, "vehicles" with every other vehicle that changed in one
+    # batch, at most ?rate= (default shared_data.map_push_rate) per second
+    rate = request.args.get('rate', default=shared_data.map_push_rate, type=float)
+
+    def events():
+        # The subscription posts its deliveries here, they run in this response thread
+        posted = queue.SimpleQueue()
+        ready = []
+        sub = shared_data.bus.subscribe(('gps', 'markers', 'vehicles'), ready.append, max_rate=rate,
+                                        poster=lambda func, delay: posted.put((time.monotonic() + delay, func)))
+        try:
+            markers_version = shared_data.markers_version
+            deltas = VehicleDeltas()
+            pose = pose_fields(shared_data.snapshot())
+            yield sse('markers', marker_fields())
+            yield sse('pose', pose)
+            while True:
+                try:
+                    due, func = posted.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n" # also how a closed connection gets noticed
+                    continue
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                func()
+                if not ready:
+                    continue
+                ready.clear()
+                if shared_data.markers_version != markers_version:
+                    markers_version = shared_data.markers_version
+                    yield sse('markers', marker_fields())
+                state_pose = pose_fields(shared_data.snapshot())
+                if state_pose != pose:
+                    pose = state_pose
+                    yield sse('pose', pose)
+                changed = deltas.batch()
+                if changed:
+                    yield sse('vehicles', {'active': shared_data.active_vehicle, 'vehicles': changed})
+        finally:
+            shared_data.bus.unsubscribe(sub)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def tile(z, x, y):
+    # Out of range numbers are never looked up, upstream or in the store
+    if not valid_tile(z, x, y):
+        return Response(status=404)
+    data = get_tile_cache().tile(z, x, y)
+    if data is None:
+        return Response(status=404)
+    return Response(data, mimetype='image/png', headers={'Cache-Control': 'public, max-age=86400'})
+
+@app.route('/tiles/prefetch', methods=['POST'])
+def tiles_prefetch():
+    # {"bbox": [west, south, east, north], "zoom": [min, max]}
+    data = request.get_json(silent=True) or {}
+    try:
+        min_zoom, max_zoom = (int(z) for z in data.get('zoom', (10, 16)))
+        job = get_tile_cache().prefetch(data['bbox'], range(min_zoom, max_zoom + 1), float(data.get('delay', 0.1)))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"bad prefetch request: {e}"}), 400
+    return jsonify(job.stats())
+
+@app.route('/tiles/stats')
+def tiles_stats():
+    return jsonify(get_tile_cache().stats())
+
+def json_object():
+    # Body of a JSON request, {} when it has none or isn't an object
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def mission_item(item, dist=None):
+    data = item._asdict()
+    if dist is not None:
+        data['dist'] = dist
+    return data
+
+@app.route('/mission')
+def mission():
+    # Whole mission, or with ?bbox= the items in view (?kind=, ?limit=)
+    bbox = viewport()
+    if bbox is None:
+        return jsonify(shared_data.mission.to_dict())
+    items = shared_data.mission.in_viewport(*bbox, kind=request.args.get('kind'),
+                                            limit=request.args.get('limit', type=int))
+    return jsonify({'version': shared_data.mission.version, 'items': [mission_item(item) for item in items]})
+
+@app.route('/mission/item', methods=['POST'])
+def mission_add():
+    # {"kind": "wp"|"poi", "lat", "lon", "alt", "name", "position"}, fences are /geofence/zone
+    data = json_object()
+    try:
+        position = data.get('position')
+        item = shared_data.mission.add(data['kind'], float(data['lat']), float(data['lon']), float(data.get('alt', 0.0)),
+                                       str(data.get('name', "")), None if position is None else int(position))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"bad mission item: {e}"}), 400
+    shared_data.markers_changed()
+    return jsonify(mission_item(item))
+
+@app.route('/mission/move', methods=['POST'])
+def mission_move():
+    data = json_object()
+    try:
+        item_id, lat, lon = int(data['id']), float(data['lat']), float(data['lon'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"id, lat and lon required: {e}"}), 400
+    try:
+        item = shared_data.mission.move(item_id, lat, lon)
+    except KeyError:
+        return jsonify({'status': 'unknown item'}), 404
+    except ValueError as e:
+        return jsonify({'status': str(e)}), 400
+    shared_data.markers_changed()
+    return jsonify(mission_item(item))
+
+@app.route('/mission/remove', methods=['POST'])
+def mission_remove():
+    try:
+        item_id = int(json_object()['id'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"id required: {e}"}), 400
+    try:
+        shared_data.mission.remove(item_id)
+    except KeyError:
+        return jsonify({'status': 'unknown item'}), 404
+    shared_data.markers_changed()
+    return jsonify({'status': 'success'})
+
+@app.route('/mission/clear', methods=['POST'])
+def mission_clear():
+    try:
+        shared_data.mission.clear(json_object().get('kind'))
+    except ValueError as e:
+        return jsonify({'status': str(e)}), 400
+    shared_data.markers_changed()
+    return jsonify({'status': 'success'})
+
+@app.route('/mission/export')
+def mission_export():
+    # Waypoints in flight order with their MGRS grid, converted in one batch
+    waypoints = shared_data.mission.waypoint_list()
+    precision = request.args.get('precision', default=geospatial.MGRS_PRECISION, type=int)
+    grids = geospatial.latlon_to_mgrs_batch([wp.lat for wp in waypoints], [wp.lon for wp in waypoints], precision)
+    return jsonify([{'number': number + 1, 'id': wp.id, 'name': wp.name, 'lat': wp.lat, 'lon': wp.lon,
+                     'alt': wp.alt, 'mgrs': grid} for number, (wp, grid) in enumerate(zip(waypoints, grids))])
+
+@app.route('/mission/nearest')
+def mission_nearest():
+    try:
+        item, dist = shared_data.mission.nearest(request.args.get('lat', type=float), request.args.get('lon', type=float),
+                                                 request.args.get('kind'), request.args.get('max_dist', type=float))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'lat and lon required'}), 400
+    return jsonify(None if item is None else mission_item(item, dist))
+
+@app.route('/mission/hit')
+def mission_hit():
+    # Items within ?radius= meters of a click, nearest first
+    try:
+        hits = shared_data.mission.hit_test(request.args.get('lat', type=float), request.args.get('lon', type=float),
+                                            request.args.get('radius', default=20.0, type=float), request.args.get('kind'))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'lat and lon required'}), 400
+    return jsonify([mission_item(item, dist) for dist, item in hits])
+
+@app.route('/mission/next', methods=['GET', 'POST'])
+def mission_next():
+    # GET: next waypoint and distance from the active vehicle, POST {"number": N} to change it
+    if request.method == 'POST':
+        try:
+            number = int(json_object()['number'])
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'status': f"number required: {e}"}), 400
+        shared_data.mission.set_next(number)
+        shared_data.markers_changed()
+    pos = shared_data.snapshot().pos_uav
+    number, item, dist, brg = shared_data.mission.distance_to_next(pos.lat, pos.lon)
+    if item is None:
+        return jsonify(None)
+    return jsonify({'number': number, 'item': mission_item(item), 'dist': dist, 'bearing': brg,
+                    'remaining': shared_data.mission.remaining_distance(pos.lat, pos.lon)})
+
+@app.route('/geofence')
+def geofence():
+    return jsonify(shared_data.geofence.to_dict())
+
+@app.route('/geofence/zone', methods=['POST'])
+def geofence_add():
+    # {"shape": "polygon", "points": [[lat, lon], ...]} or {"shape": "circle", "lat", "lon", "radius"},
+    # with "inclusion" (default false: a zone to stay out of) and "name"
+    data = json_object()
+    try:
+        if data.get('shape', 'polygon') == 'circle':
+            zone = shared_data.geofence.add_circle(float(data['lat']), float(data['lon']), float(data['radius']),
+                                                   data.get('inclusion', False), str(data.get('name', "")))
+        else:
+            zone = shared_data.geofence.add_polygon(data['points'], data.get('inclusion', False), str(data.get('name', "")))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"bad zone: {e}"}), 400
+    shared_data.fences_changed()
+    return jsonify(zone._asdict())
+
+@app.route('/geofence/remove', methods=['POST'])
+def geofence_remove():
+    try:
+        zone_id = int(json_object()['id'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': f"id required: {e}"}), 400
+    try:
+        shared_data.geofence.remove(zone_id)
+    except KeyError:
+        return jsonify({'status': 'unknown zone'}), 404
+    shared_data.fences_changed()
+    return jsonify({'status': 'success'})
+
+@app.route('/geofence/clear', methods=['POST'])
+def geofence_clear():
+    shared_data.geofence.clear()
+    shared_data.fences_changed()
+    return jsonify({'status': 'success'})
+
+@app.route('/geofence/check')
+def geofence_check():
+    # Status of ?lat=&lon=, by default of the active vehicle
+    pos = shared_data.snapshot().pos_uav
+    lat = request.args.get('lat', default=pos.lat, type=float)
+    lon = request.args.get('lon', default=pos.lon, type=float)
+    return jsonify(shared_data.check_fence(geospatial.GPSposition(lat, lon, 0))._asdict())
+
+@app.route('/terrain/elevation', methods=['GET', 'POST'])
+def terrain_elevation():
+    # GET ?lat=&lon= for one point, POST {"lats": [...], "lons": [...]} for many, null without data
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            heights = get_terrain().elevations(data['lats'], data['lons'])
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'status': f"lats and lons arrays required: {e}"}), 400
+        return jsonify([None if math.isnan(h) else h for h in heights.reshape(-1).tolist()])
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        return jsonify({'status': 'lat and lon required'}), 400
+    return jsonify(get_terrain().elevation(lat, lon))
+
+@app.route('/terrain/ray')
+def terrain_ray():
+    # Ground point seen from the active vehicle at ?az= degrees from north and ?ang= degrees off nadir
+    pos = shared_data.snapshot().pos_uav
+    az = request.args.get('az', type=float)
+    ang = request.args.get('ang', type=float)
+    max_range = request.args.get('range', default=20000.0, type=float)
+    if az is None or ang is None or not 0 < max_range <= 100000:
+        return jsonify({'status': 'az and ang required, range up to 100 km'}), 400
+    hit = get_terrain().ray_to_ground(pos, az, ang, max_range)
+    return jsonify(None if hit is None else {'lat': hit.lat, 'lon': hit.lon, 'alt': hit.alt,
+                                             'dist': geospatial.gps_to_vector(pos, hit).dist})
+
+@app.route('/terrain/los')
+def terrain_los():
+    # Line of sight from the active vehicle to ?lat=&lon=&alt= (MSL), by default to the ground there
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        return jsonify({'status': 'lat and lon required'}), 400
+    alt = request.args.get('alt', type=float)
+    if alt is None:
+        alt = get_terrain().elevation(lat, lon)
+        if alt is None:
+            return jsonify({'status': 'no terrain data at the target, give alt'}), 400
+    target = geospatial.GPSposition(lat, lon, alt)
+    visible, blocked = get_terrain().line_of_sight(shared_data.snapshot().pos_uav, target)
+    return jsonify({'visible': visible,
+                    'blocked': None if blocked is None else {'lat': blocked.lat, 'lon': blocked.lon, 'alt': blocked.alt}})
 
 @app.route('/set_position', methods=['POST'])
 def set_position():
@@ -78,5 +527,39 @@ def shutdown():
     os._exit(0)
     return jsonify({'status': 'success'})
 
-def run_flask():
-    app.run(threaded=True)
+server_ready = threading.Event() # set once the server is listening
+server = None
+
+def run_flask(mode=None, host=None, port=None):
+    # mode "waitress" (default) or "dev" for the Werkzeug development server.
+    # Blocks serving, wait on server_ready from the starting thread.
+    global server
+    mode = mode or shared_data.map_server_mode
+    host = host or shared_data.map_server_host
+    port = port or shared_data.map_server_port
+    assets.asset_cache.preload()
+    if mode == "waitress":
+        try:
+            from waitress import create_server
+        except ImportError:
+            print("waitress is not installed, using the development server")
+            mode = "dev"
+    if mode == "waitress":
+        # Every /stream client holds a worker thread for as long as it is connected
+        server = create_server(app, host=host, port=port, threads=shared_data.map_server_threads,
+                               channel_timeout=60, ident="minimgcs")
+        server_ready.set()
+        server.run()
+    else:
+        from werkzeug.serving import make_server
+        server = make_server(host, port, app, threaded=True)
+        server_ready.set()
+        server.serve_forever()
+
+def start_map_server(timeout=10):
+    # Starts run_flask on a daemon thread and returns once it accepts connections
+    thread = threading.Thread(target=run_flask, daemon=True)
+    thread.start()
+    if not server_ready.wait(timeout):
+        raise RuntimeError("map server did not start")
+    return thread
@@ -0,0 +1,274 @@
+# mission.py
+# Mission store: waypoints and POIs, with a uniform grid index over them so
+# nearest, hit-test and viewport queries only look at a few cells however
+# large the mission is. Geofences are zones of geofence.GeofenceEngine.
+import collections
+import itertools
+import math
+import threading
+
+EARTH_RADIUS = 6371008.8
+CELL_SIZE = 250.0 # grid cell edge in meters
+KINDS = ("wp", "poi")
+
+MissionItem = collections.namedtuple('MissionItem', ['id', 'kind', 'lat', 'lon', 'alt', 'name'])
+
+
+def check_position(lat, lon):
+    # ValueError unless lat, lon is a point on the globe (NaN isn't)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Position {lat}, {lon} out of range")
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great circle distance in meters, well within 0.5% of the ellipsoid at mission scales
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def bearing(lat1, lon1, lat2, lon2):
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dl = math.radians(lon2 - lon1)
+    y = math.sin(dl) * math.cos(p2)
+    x = math.cos(p1) * math.sin(p2) - math.sin(p1) * math.cos(p2) * math.cos(dl)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+class GridIndex():
+    # Items bucketed by cell of a fixed degree grid. The longitude step is
+    # scaled for the latitude of the first item so cells are about square.
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = collections.defaultdict(dict)
+        self.lat_step = None
+        self.lon_step = None
+        self.bounds = None # (min y, min x, max y, max x) of cells ever used
+
+    def setup(self, lat):
+        self.lat_step = math.degrees(self.cell_size / EARTH_RADIUS)
+        self.lon_step = self.lat_step / max(0.01, math.cos(math.radians(lat)))
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.lat_step)), int(math.floor(lon / self.lon_step))
+
+    def add(self, item):
+        if self.lat_step is None:
+            self.setup(item.lat)
+        key = self.cell(item.lat, item.lon)
+        self.cells[key][item.id] = item
+        if self.bounds is None:
+            self.bounds = key + key
+        else:
+            y0, x0, y1, x1 = self.bounds
+            self.bounds = (min(y0, key[0]), min(x0, key[1]), max(y1, key[0]), max(x1, key[1]))
+
+    def remove(self, item):
+        key = self.cell(item.lat, item.lon)
+        cell = self.cells.get(key)
+        if cell is not None:
+            cell.pop(item.id, None)
+            if not cell:
+                del self.cells[key]
+
+    def clear(self):
+        self.cells.clear()
+        self.lat_step = None
+        self.bounds = None
+
+    def ring(self, center, r):
+        # Cells at Chebyshev distance r from center
+        cy, cx = center
+        if r == 0:
+            yield center
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield cy - r, x
+            yield cy + r, x
+        for y in range(cy - r + 1, cy + r):
+            yield y, cx - r
+            yield y, cx + r
+
+    def nearest(self, lat, lon, accept=None, max_dist=None):
+        # Searches rings of cells outwards until the next ring can't hold anything closer
+        if self.lat_step is None or not self.cells:
+            return None, None
+        center = self.cell(lat, lon)
+        y0, x0, y1, x1 = self.bounds
+        max_ring = max(abs(center[0] - y0), abs(center[0] - y1), abs(center[1] - x0), abs(center[1] - x1))
+        if max_dist is not None:
+            max_ring = min(max_ring, int(max_dist / self.cell_size) + 1)
+        best = None
+        best_dist = math.inf if max_dist is None else max_dist
+        for r in range(max_ring + 1):
+            if best is not None and (r - 1) * self.cell_size > best_dist:
+                break
+            for key in self.ring(center, r):
+                cell = self.cells.get(key)
+                if not cell:
+                    continue
+                for item in cell.values():
+                    if accept is not None and not accept(item):
+                        continue
+                    dist = haversine(lat, lon, item.lat, item.lon)
+                    if dist <= best_dist:
+                        best, best_dist = item, dist
+        return best, (best_dist if best is not None else None)
+
+    def within(self, lat, lon, radius):
+        # Items within radius meters, nearest first
+        if self.lat_step is None:
+            return []
+        cy, cx = self.cell(lat, lon)
+        n = int(radius / self.cell_size) + 1
+        found = []
+        for y in range(cy - n, cy + n + 1):
+            for x in range(cx - n, cx + n + 1):
+                for item in self.cells.get((y, x), {}).values():
+                    dist = haversine(lat, lon, item.lat, item.lon)
+                    if dist <= radius:
+                        found.append((dist, item))
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+    def in_bbox(self, west, south, east, north):
+        if self.lat_step is None:
+            return
+        y0, x0 = self.cell(south, west)
+        y1, x1 = self.cell(north, east)
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self.cells):
+            # Zoomed far out, walking the occupied cells is cheaper
+            keys = [key for key in self.cells if y0 <= key[0] <= y1 and x0 <= key[1] <= x1]
+        else:
+            keys = ((y, x) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1))
+        for key in keys:
+            for item in self.cells.get(key, {}).values():
+                if south <= item.lat <= north and west <= item.lon <= east:
+                    yield item
+
+
+class MissionStore():
+    def __init__(self, cell_size=CELL_SIZE):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.index = GridIndex(cell_size)
+        self.waypoints = [] # ids in flight order
+        self.next_wp = 0 # position in waypoints of the one being flown to
+        self.ids = itertools.count(1)
+        self.version = 0 # bumped on every change
+
+    def add(self, kind, lat, lon, alt=0.0, name="", position=None):
+        # position: where to insert a waypoint in the flight order, default last
+        if kind not in KINDS:
+            raise ValueError(f"Unknown mission item kind {kind}")
+        check_position(lat, lon)
+        with self.lock:
+            item = MissionItem(next(self.ids), kind, lat, lon, alt, name)
+            self.items[item.id] = item
+            self.index.add(item)
+            if kind == "wp":
+                count = len(self.waypoints)
+                position = count if position is None else max(0, min(position, count))
+                self.waypoints.insert(position, item.id)
+                # Inserted at or before the one being flown to: keep flying to it. One
+                # appended after the last reached becomes the next.
+                if position < self.next_wp or position == self.next_wp < count:
+                    self.next_wp += 1
+            self.version += 1
+            return item
+
+    def move(self, item_id, lat, lon):
+        # KeyError for an unknown id
+        check_position(lat, lon)
+        with self.lock:
+            item = self.items[item_id]
+            self.index.remove(item)
+            item = self.items[item_id] = item._replace(lat=lat, lon=lon)
+            self.index.add(item)
+            self.version += 1
+            return item
+
+    def remove(self, item_id):
+        # KeyError for an unknown id
+        with self.lock:
+            item = self.items.pop(item_id)
+            self.index.remove(item)
+            if item.kind == "wp":
+                position = self.waypoints.index(item_id)
+                del self.waypoints[position]
+                if position < self.next_wp:
+                    self.next_wp -= 1
+            self.version += 1
+            return item
+
+    def clear(self, kind=None):
+        if kind is not None and kind not in KINDS:
+            raise ValueError(f"Unknown mission item kind {kind}")
+        with self.lock:
+            for item in [item for item in self.items.values() if kind is None or item.kind == kind]:
+                del self.items[item.id]
+                self.index.remove(item)
+            if kind in (None, "wp"):
+                self.waypoints = []
+                self.next_wp = 0
+            if not self.items:
+                self.index.clear()
+            self.version += 1
+
+    def nearest(self, lat, lon, kind=None, max_dist=None):
+        # (item, distance in meters), (None, None) when there is none
+        check_position(lat, lon)
+        with self.lock:
+            accept = None if kind is None else (lambda item: item.kind == kind)
+            return self.index.nearest(lat, lon, accept, max_dist)
+
+    def hit_test(self, lat, lon, radius, kind=None):
+        # Items within radius meters of a click, nearest first
+        check_position(lat, lon)
+        with self.lock:
+            return [(dist, item) for dist, item in self.index.within(lat, lon, radius)
+                    if kind is None or item.kind == kind]
+
+    def in_viewport(self, west, south, east, north, kind=None, limit=None):
+        with self.lock:
+            items = [item for item in self.index.in_bbox(west, south, east, north) if kind is None or item.kind == kind]
+        if limit is not None:
+            items = items[:limit]
+        return items
+
+    def waypoint_list(self):
+        with self.lock:
+            return [self.items[item_id] for item_id in self.waypoints]
+
+    def next_waypoint(self):
+        with self.lock:
+            if self.next_wp < len(self.waypoints):
+                return self.next_wp, self.items[self.waypoints[self.next_wp]]
+            return None, None
+
+    def set_next(self, position):
+        with self.lock:
+            self.next_wp = max(0, min(position, len(self.waypoints)))
+            self.version += 1
+
+    def distance_to_next(self, lat, lon):
+        # (number, waypoint, distance in meters, bearing in degrees) of the next waypoint
+        number, item = self.next_waypoint()
+        if item is None:
+            return None, None, None, None
+        return number, item, haversine(lat, lon, item.lat, item.lon), bearing(lat, lon, item.lat, item.lon)
+
+    def remaining_distance(self, lat, lon):
+        # Along the rest of the mission from lat, lon
+        with self.lock:
+            waypoints = [self.items[item_id] for item_id in self.waypoints[self.next_wp:]]
+        total = 0.0
+        for item in waypoints:
+            total += haversine(lat, lon, item.lat, item.lon)
+            lat, lon = item.lat, item.lon
+        return total
+
+    def to_dict(self):
+        with self.lock:
+            return {'version': self.version, 'next_wp': self.next_wp, 'waypoints': list(self.waypoints),
+                    'items': [item._asdict() for item in self.items.values()]}
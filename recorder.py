@@ -0,0 +1,191 @@
+# recorder.py
+# Raw CRSF flight recorder.
+#
+# name.crsf        capture: 16 byte header, then per frame a '<dHB' record header
+#                  (arrival time, source number, length) followed by the frame bytes
+# name.crsf.idx    index: one fixed 24 byte '<dQHB5x' entry per frame
+#                  (arrival time, capture offset, source number, frame type)
+# name.crsf.json   source numbers -> source ids
+#
+# Both binary files are append only and memory mappable, the index is sorted
+# by time (frames are recorded in arrival order) so time ranges are found by
+# binary search and type/source filters only touch the index.
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b'MGCSCRSF'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('<8sH6x')
+RECORD_HEADER = struct.Struct('<dHB')
+INDEX_ENTRY = struct.Struct('<dQHB5x')
+
+
+class FlightRecorder():
+    def __init__(self, path, flush_interval=1.0, buffer_size=1 << 20):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.queue = queue.SimpleQueue()
+        self.sources = {}
+        self.thread = None
+        self.frames = 0
+        self.bytes = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record(self, timestamp, source_id, frame):
+        # Called from the telemetry thread, only copies the frame and queues it
+        self.queue.put((timestamp, source_id, bytes(frame)))
+
+    def write_sources(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'version': CAPTURE_VERSION, 'sources': list(self.sources)}, f)
+
+    def writer(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'wb', buffering=self.buffer_size) as capture, \
+             open(self.path + '.idx', 'wb', buffering=self.buffer_size) as index:
+            capture.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+            offset = CAPTURE_HEADER.size
+            self.write_sources()
+            last_flush = time.monotonic()
+            running = True
+            while running:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = False
+                # Drain everything queued so far before touching the disk again
+                while item is not False:
+                    if item is None:
+                        running = False
+                        break
+                    timestamp, source_id, frame = item
+                    source = self.sources.get(source_id)
+                    if source is None:
+                        source = self.sources[source_id] = len(self.sources)
+                        self.write_sources()
+                    capture.write(RECORD_HEADER.pack(timestamp, source, len(frame)))
+                    capture.write(frame)
+                    index.write(INDEX_ENTRY.pack(timestamp, offset, source, frame[2] if len(frame) > 2 else 0))
+                    offset += RECORD_HEADER.size + len(frame)
+                    self.frames += 1
+                    self.bytes = offset
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        item = False
+                if not running or time.monotonic() - last_flush >= self.flush_interval:
+                    # Capture first, so an index entry never points past the capture
+                    capture.flush()
+                    index.flush()
+                    last_flush = time.monotonic()
+
+
+class CaptureReader():
+    # Read access to a capture without parsing it, frames are memoryviews into the mapping
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json') as f:
+            self.sources = json.load(f)['sources']
+        self.capture_file = open(path, 'rb')
+        self.capture = mmap.mmap(self.capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = CAPTURE_HEADER.unpack_from(self.capture, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError(f"{path} is not a version {CAPTURE_VERSION} CRSF capture")
+        self.index_file = open(path + '.idx', 'rb')
+        if os.fstat(self.index_file.fileno()).st_size:
+            self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.index = b''
+        self.count = len(self.index) // INDEX_ENTRY.size
+        # Drop trailing entries the capture doesn't cover yet (recording in progress or cut short)
+        while self.count and self.entry(self.count - 1)[1] + RECORD_HEADER.size > len(self.capture):
+            self.count -= 1
+        if self.count:
+            offset = self.entry(self.count - 1)[1]
+            if offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(self.capture, offset)[2] > len(self.capture):
+                self.count -= 1
+        self.capture_view = memoryview(self.capture)
+
+    def close(self):
+        self.capture_view.release()
+        self.capture.close()
+        self.capture_file.close()
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+    def time_range(self):
+        if not self.count:
+            return None
+        return self.entry(0)[0], self.entry(self.count - 1)[0]
+
+    def find_time(self, timestamp):
+        # Index of the first frame at or after timestamp
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def frame_at(self, offset):
+        timestamp, source, length = RECORD_HEADER.unpack_from(self.capture, offset)
+        start = offset + RECORD_HEADER.size
+        return timestamp, self.sources[source], self.capture_view[start:start + length]
+
+    def frames(self, start=None, end=None, ptypes=None, sources=None):
+        # Yields (timestamp, source_id, frame) between start and end (time.time() values)
+        first = 0 if start is None else self.find_time(start)
+        last = self.count if end is None else self.find_time(end)
+        if ptypes is not None:
+            ptypes = set(int(p) for p in ptypes)
+        if sources is not None:
+            sources = set(self.sources.index(s) for s in sources if s in self.sources)
+        index = memoryview(self.index)[first * INDEX_ENTRY.size:last * INDEX_ENTRY.size]
+        for timestamp, offset, source, ptype in INDEX_ENTRY.iter_unpack(index):
+            if ptypes is not None and ptype not in ptypes:
+                continue
+            if sources is not None and source not in sources:
+                continue
+            yield self.frame_at(offset)
+
+    def count_types(self):
+        counts = {}
+        for timestamp, offset, source, ptype in INDEX_ENTRY.iter_unpack(memoryview(self.index)[:self.count * INDEX_ENTRY.size]):
+            counts[ptype] = counts.get(ptype, 0) + 1
+        return counts
+
+
+def start_recorder(path):
+    # path may contain time.strftime fields, e.g. "logs/flight_%Y%m%d_%H%M%S.crsf"
+    return FlightRecorder(time.strftime(path)).start()
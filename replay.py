@@ -0,0 +1,111 @@
+# replay.py
+# Plays a recorder.py capture back through the live framer/decoder path
+import threading
+import time
+from shared_data import shared_data, DEFAULT_VEHICLE
+from recorder import CaptureReader
+from telemetry import CrsfFramer, crsf_crc_error, handleCrsfPacket
+
+
+class ReplayEngine():
+    # speed: 1.0 real time, N for N times faster, 0 for as fast as possible
+    def __init__(self, path, speed=1.0, loop=False, on_frame=None):
+        self.reader = CaptureReader(path)
+        self.framer = CrsfFramer(on_error=crsf_crc_error)
+        self.speed = speed
+        self.loop = loop
+        self.on_frame = on_frame or self.handle_frame
+        self.position = 0
+        self.seek_request = None
+        self.stopped = False
+        self.capture_time = 0 # capture timestamp of the last frame played
+        self.frames = 0
+        self.elapsed = 0.0
+
+    def handle_frame(self, capture_time, source_id, frame, timestamp):
+        # Captures keep the source, not the vehicle: like live links without a
+        # named vehicle, every source plays back as the one default vehicle
+        handleCrsfPacket(frame[2], frame, timestamp, DEFAULT_VEHICLE)
+
+    def seek(self, capture_time):
+        # Can be called from any thread, picked up before the next frame
+        self.seek_request = capture_time
+
+    def stop(self):
+        self.stopped = True
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'elapsed': self.elapsed,
+            'fps': self.frames / self.elapsed if self.elapsed else 0.0,
+            'position': self.position,
+            'length': len(self.reader),
+            'capture_time': self.capture_time,
+        }
+
+    def run(self):
+        reader = self.reader
+        if not len(reader):
+            return
+        started = time.perf_counter()
+        # Wall clock and capture time that are played back at the same moment
+        wall_ref = started
+        capture_ref = reader.entry(0)[0]
+        while not self.stopped:
+            if self.seek_request is not None:
+                self.position = reader.find_time(self.seek_request)
+                self.seek_request = None
+                self.framer.reset()
+                if self.position < len(reader):
+                    wall_ref = time.perf_counter()
+                    capture_ref = reader.entry(self.position)[0]
+            if self.position >= len(reader):
+                if not self.loop:
+                    break
+                self.seek(reader.entry(0)[0])
+                continue
+
+            capture_time, offset = reader.entry(self.position)[:2]
+            if self.speed:
+                wait = wall_ref + (capture_time - capture_ref) / self.speed - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            self.position += 1
+
+            capture_time, source, data = reader.frame_at(offset)
+            timestamp = time.time()
+            for frame in self.framer.feed(data):
+                self.on_frame(capture_time, source, frame, timestamp)
+                self.frames += 1
+            self.capture_time = capture_time
+        self.elapsed = time.perf_counter() - started
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+
+def start_replay(path, speed=1.0, loop=False):
+    engine = ReplayEngine(path, speed, loop)
+    shared_data.replay = engine
+    engine.start()
+    return engine
+
+if __name__ == '__main__':
+    # Throughput check of the framer/decoder path: python replay.py capture.crsf --speed 0
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a CRSF capture")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--seek", type=float, default=None, help="capture time (unix seconds) to start at")
+    parser.add_argument("--print", action="store_true", help="print decoded telemetry")
+    args = parser.parse_args()
+    shared_data.printtele = args.print
+    engine = ReplayEngine(args.path, args.speed)
+    if args.seek is not None:
+        engine.seek(args.seek)
+    engine.run()
+    stats = engine.stats()
+    print(f"{stats['frames']} frames in {stats['elapsed']:.3f}s, {stats['fps']:.0f} frames/s")
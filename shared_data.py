@@ -1,37 +1,226 @@
 # shared_data.py
 import threading
+import collections
+import math
+import time
 import geospatial
+from mission import MissionStore
+from geofence import GeofenceEngine, NO_FENCE
+
+class LatencyStats():
+    # Rolling window of latency samples in seconds
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def report(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+        return {
+            'count': len(samples),
+            'p50_ms': samples[len(samples) // 2] * 1000,
+            'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            'max_ms': samples[-1] * 1000,
+        }
+
+# Every vehicle (one or more telemetry links) has its own TelemetryState in
+# shared_data.vehicles, keyed by vehicle id. One of them is the active vehicle,
+# its state is also shared_data.state and drives the UI.
+DEFAULT_VEHICLE = "uav" # id for telemetry that doesn't name its vehicle
+
+# Vehicle telemetry lives in one immutable TelemetryState. The writer builds a
+# new state per decoded frame and swaps it in with publish(), readers take
+# snapshot() once and read every field from it, so a lat can't come from one
+# GPS frame and the lon from the next. seq goes up on every publish, readers
+# can skip work when it hasn't changed.
+TELEMETRY_DEFAULTS = {
+    'got_gps': False,
+    'last_time_telemetry': 0, # arrival time of the last telemetry frame
+    'mode': "ANGLE",
+    'flightmode': "NONE",
+    'pitch': 0.0,
+    'roll': 0.0,
+    'yaw': 0.0,
+    'pos_uav': geospatial.GPSposition(0,0,0), # replaced, never modified in place
+    'gspd': 0.0,
+    'hdg': 0.0,
+    'baro_alt': 0.0,
+    'sats': 0,
+    'vspd': 0.0,
+    'rssi1': -10.0,
+    'rssi2': 0.0,
+    'snr': 0.0,
+    'lq': 0,
+    'vbat': 0.0,
+    'curr': 0.0,
+    'mah': 0.0,
+    'pct': 0.0,
+    'fence': NO_FENCE, # geofence.FenceStatus of pos_uav, see SharedData.check_fence()
+}
+
+class TelemetryState(collections.namedtuple('TelemetryState', ['seq'] + list(TELEMETRY_DEFAULTS))):
+    __slots__ = ()
+
+DEFAULT_STATE = TelemetryState(seq=0, **TELEMETRY_DEFAULTS)
+STATE_INDEX = {name: i for i, name in enumerate(TelemetryState._fields)}
+
+# Change notification topics, derived from the fields a publish touches
+STATE_TOPICS = {
+    'attitude': ('pitch', 'roll', 'yaw'),
+    'gps': ('got_gps', 'pos_uav', 'gspd', 'hdg', 'sats'),
+    'battery': ('vbat', 'curr', 'mah', 'pct'),
+    'link': ('rssi1', 'rssi2', 'snr', 'lq', 'mode'),
+    'flight_mode': ('flightmode',),
+    'vario': ('vspd',),
+    'baro': ('baro_alt',),
+    'fence': ('fence',),
+    'telemetry': ('last_time_telemetry',), # any frame
+    'markers': (), # user/home/goto/poi/wp markers or map lock, see markers_changed()
+    'vehicles': (), # any vehicle's state, see SharedData.vehicles
+}
+FIELD_TOPIC = {field: topic for topic, fields in STATE_TOPICS.items() for field in fields}
+
+def call_now(func, delay):
+    # Default poster: run in the publishing thread, delayed calls on a timer thread
+    if delay > 0:
+        threading.Timer(delay, func).start()
+    else:
+        func()
+
+class Subscription():
+    # Delivers the latest state to callback on the poster's thread.
+    # coalesce: while a delivery is pending further publishes only update the
+    # state it will carry. max_rate: deliveries per second at most, later ones wait.
+    def __init__(self, topics, callback, max_rate=None, coalesce=True, poster=None):
+        self.topics = topics
+        self.callback = callback
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.coalesce = coalesce
+        self.poster = poster or call_now
+        self.latest = None
+        self.pending = False
+        self.last_delivery = 0.0
+        self.active = True
+
+    def notify(self, state):
+        self.latest = state
+        if self.coalesce:
+            if self.pending:
+                return
+            self.pending = True
+            self.poster(self.deliver, 0)
+        else:
+            self.poster(lambda: self.callback(state), 0)
+
+    def deliver(self):
+        wait = self.last_delivery + self.min_interval - time.monotonic()
+        if wait > 0:
+            self.poster(self.deliver, wait)
+            return
+        self.pending = False
+        self.last_delivery = time.monotonic()
+        if self.active:
+            self.callback(self.latest)
+
+class StateBus():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {topic: () for topic in STATE_TOPICS}
+
+    def subscribe(self, topics, callback, max_rate=None, coalesce=True, poster=None):
+        # topics: one topic name or several, see STATE_TOPICS
+        if isinstance(topics, str):
+            topics = (topics,)
+        sub = Subscription(tuple(topics), callback, max_rate, coalesce, poster)
+        with self.lock:
+            for topic in sub.topics:
+                # Copy on write, notify() iterates without the lock
+                self.subscribers[topic] = self.subscribers[topic] + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.active = False
+        with self.lock:
+            for topic in sub.topics:
+                self.subscribers[topic] = tuple(s for s in self.subscribers[topic] if s is not sub)
+
+    def notify(self, topics, state):
+        notified = set()
+        for topic in topics:
+            for sub in self.subscribers[topic]:
+                # One notification per publish even when several of its topics changed
+                if sub not in notified:
+                    notified.add(sub)
+                    sub.notify(state)
 
 class SharedData:
     def __init__(self):
         self.lock = threading.Lock()
+        self.publish_lock = threading.Lock() # serializes writers only
+        self.state = DEFAULT_STATE
+        self.seq = 0 # last seq handed out, shared by all vehicles so it never goes back
+        self.vehicles = {} # vehicle id -> TelemetryState, replaced when a vehicle is added
+        self.active_vehicle = None # the first vehicle heard from unless selected
+        self.tracks = {} # vehicle id -> list of GPSposition
+        self.bus = StateBus()
         self.video_source = "video.mp4"
         self.telem_port = "/dev/ttyACM0"
         self.telem_baud = 420000
+        self.telem_read_mode = "blocking" # "blocking" or "poll"
         self.scells = 3 # battery serial cells
         self.warnings=[]
-        self.telemetry = "random"  # Can be "random" or "crsf"
+        self.telemetry = "random"  # Can be "random", "crsf", "hub" or "replay"
+        self.sim_vehicles = 0 # extra simulated vehicles with "random"
+        self.sim_vehicle_rate = 10 # updates per second of each
+        self.sim_vehicle_tracks = False # keep their tracks too, count * rate points a second for the whole session
+        self.telem_sources = ["serial:/dev/ttyACM0:420000"] # for "hub", see transport.source_from_url
+        self.telemetry_hub = None
+        self.record_path = None # e.g. "logs/flight_%Y%m%d_%H%M%S.crsf", raw frames are recorded when set
+        self.recorder = None
+        self.replay_path = None # recorder capture played back by "replay"
+        self.replay_speed = 1.0 # 1.0 real time, N times faster, 0 as fast as possible
+        self.replay_loop = False
+        self.replay = None
         self.telemetry_connected = False
+        self.crsf_framer = None
         self.printtele = True
+        self.log_output = "stdout" # "stdout" or "terminal" (GUI terminal widget)
+        self.log_rate_limits = {} # frame type or log kind -> max lines per second
+        self.log_sample = {} # frame type or log kind -> log 1 in N
         self.error = False
-        self.got_gps = False
-        self.last_time_telemetry = 0
-        self.mode = "ANGLE"
-        self.flightmode = "NONE"
-        self.pitch = 0.0
-        self.roll = 0.0
+        self.display_latency = LatencyStats() # frame arrival -> shown in the UI
         self.telemetry_lost = False
         self.map_center = False
-        self.log_pos = []
-        self.pos_uav = geospatial.GPSposition(0,0,0)
+        self.markers_version = 0
+        self.map_push_rate = 10 # max /stream updates per second per client
+        self.map_bridge = True # GCS map view updated over QWebChannel when available, see map_bridge.py
+        self.map_server_mode = "waitress" # or "dev" for the Werkzeug development server
+        self.map_server_host = "127.0.0.1" # "0.0.0.0" to serve remote viewers
+        self.map_server_port = 5000
+        self.map_server_threads = 32 # waitress workers, each /stream client holds one
+        self.tile_url = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png" # upstream for the tile cache
+        self.tile_cache_path = "tiles/osm.mbtiles"
+        self.tile_memory_cache = 512 # tiles kept in memory
+        self.tiles_offline = False # serve map tiles from the local store only
+        self.tile_backoff = 30 # seconds the upstream is left alone after it couldn't be reached
+        self.terrain_path = "terrain" # folder of SRTM .hgt elevation tiles, see terrain.py
+        self.terrain_tiles = 8 # tiles kept memory-mapped
         self.user_marker_active = False
         self.pos_marker = geospatial.GPSposition(0,0,0)
         self.home_set = False
         self.pos_home = geospatial.GPSposition(0,0,0)
+        self.frame = None # cached geospatial.LocalFrame, see local_frame()
+        self.frame_reanchor = 5000 # meters, without home the frame follows the UAV in steps of this
         self.goto_set = False
         self.pos_goto = geospatial.GPSposition(0,0,0)
         self.poi_set = False
         self.pos_poi = geospatial.GPSposition(0,0,0)
+        self.mission = MissionStore() # waypoints and POIs, see mission.py
+        self.wp_accept_radius = 30 # meters, next waypoint counts as reached inside this
+        self.geofence = GeofenceEngine() # inclusion/exclusion zones, see geofence.py
         self.wp_set = False
         self.wp_n = 0
         self.pos_wp = geospatial.GPSposition(0,0,0)
@@ -48,25 +237,113 @@ class SharedData:
         self.video_zoom_h = 0
 
         self.tele_data = {}
-        self.gspd = 0.0
-        self.hdg = 0.0
-        self.baro_alt = 0.0
-        self.sats = 0
-        self.vspd = 0.0
-        self.yaw = 0.0
-        self.rssi1 = -10.0
-        self.rssi2 = 0.0
-        self.snr = 0.0
-        self.lq = 0
-        self.vbat = 0.0
-        self.curr = 0.0
-        self.mah = 0.0
-        self.pct = 0.0
         
         self.warn_vcell = 3.5
         self.warn_vbat = self.warn_vcell * self.scells
         self.warn_rssi = -100
         self.warn_lq = 50
         self.warn_sats = 8
+        self.warn_fence = 50 # meters from a fence boundary
+
+    def markers_changed(self):
+        # Call after changing any marker field or map_center
+        with self.publish_lock:
+            self.markers_version += 1
+        self.bus.notify(('markers',), self.state)
+
+    def local_frame(self, near=None):
+        # ENU frame anchored at home, rebuilt only when home moves. Until home is
+        # set it is anchored at near (a GPSposition, usually the UAV) and moved
+        # when that gets farther than frame_reanchor from it.
+        frame = self.frame
+        if self.home_set:
+            home = self.pos_home
+            if frame is None or not frame.same_origin(home.lat, home.lon, home.alt):
+                frame = self.frame = geospatial.LocalFrame(home.lat, home.lon, home.alt)
+        elif near is not None:
+            if frame is None or math.hypot(*frame.enu(near.lat, near.lon)[:2]) > self.frame_reanchor:
+                frame = self.frame = geospatial.LocalFrame(near.lat, near.lon, 0.0)
+        return frame
+
+    def check_fence(self, pos):
+        return self.geofence.check(pos.lat, pos.lon)
+
+    def fences_changed(self):
+        # Call after editing geofence zones, on the editing thread: the zones are
+        # compiled here, then every vehicle is checked again
+        self.geofence.compile()
+        for vehicle, state in list(self.vehicles.items()):
+            self.publish(vehicle, fence=self.check_fence(state.pos_uav))
+        self.markers_changed()
+
+    def snapshot(self):
+        # A single attribute read, safe from any thread without the lock
+        return self.state
+
+    @property
+    def log_pos(self):
+        # Flight track of the active vehicle
+        return self.track_of(None)
+
+    def track_of(self, vehicle):
+        vehicle = vehicle or self.active_vehicle or DEFAULT_VEHICLE
+        track = self.tracks.get(vehicle)
+        if track is None:
+            track = self.tracks.setdefault(vehicle, [])
+        return track
+
+    def publish(self, vehicle=None, **changes):
+        # vehicle None is the active vehicle. Builds the next state directly,
+        # namedtuple._replace is several times slower.
+        if 'pos_uav' in changes and self.geofence.compiled is not None:
+            # Every position is checked against the geofence as it comes in, a grid lookup
+            changes['fence'] = self.check_fence(changes['pos_uav'])
+        with self.publish_lock:
+            if vehicle is None:
+                vehicle = self.active_vehicle or DEFAULT_VEHICLE
+            if self.active_vehicle is None:
+                self.active_vehicle = vehicle
+            previous = self.vehicles.get(vehicle)
+            values = list(DEFAULT_STATE if previous is None else previous)
+            self.seq += 1
+            values[0] = self.seq
+            for name, value in changes.items():
+                values[STATE_INDEX[name]] = value
+            state = tuple.__new__(TelemetryState, values)
+            if previous is None:
+                # Copy on write, readers iterate vehicles without the lock
+                self.vehicles = {**self.vehicles, vehicle: state}
+            else:
+                self.vehicles[vehicle] = state
+            active = vehicle == self.active_vehicle
+            if active:
+                self.state = state
+        if active:
+            topics = {FIELD_TOPIC[name] for name in changes}
+            topics.add('vehicles')
+            self.bus.notify(topics, state)
+        else:
+            self.bus.notify(('vehicles',), state)
+        return state
+
+    def select_vehicle(self, vehicle):
+        # Makes another vehicle the one the UI follows
+        with self.publish_lock:
+            if vehicle not in self.vehicles:
+                raise KeyError(vehicle)
+            self.active_vehicle = vehicle
+            # Restamped with a new seq: the vehicle's last state can be older than
+            # what readers versioned by seq (e.g. /update_marker clients) already hold
+            self.seq += 1
+            state = self.state = self.vehicles[vehicle] = self.vehicles[vehicle]._replace(seq=self.seq)
+        self.bus.notify(STATE_TOPICS, state)
+
+def state_property(name):
+    # Old style shared_data.<field> access, each set is its own publish
+    return property(lambda self: getattr(self.state, name),
+                    lambda self, value: self.publish(**{name: value}))
+
+for name in TELEMETRY_DEFAULTS:
+    setattr(SharedData, name, state_property(name))
 
 shared_data = SharedData()
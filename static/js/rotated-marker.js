@@ -0,0 +1,21 @@
+// Adds rotationAngle / setRotationAngle() to L.Marker by appending a rotate()
+// to the transform Leaflet positions the icon with. Replaces leaflet-rotatedmarker.
+(function () {
+    const setPos = L.Marker.prototype._setPos;
+    L.Marker.include({
+        _setPos: function (pos) {
+            setPos.call(this, pos);
+            const angle = this.options.rotationAngle;
+            if (angle && this._icon) {
+                const anchor = this.options.icon.options.iconAnchor || [0, 0];
+                this._icon.style.transformOrigin = `${anchor[0]}px ${anchor[1]}px`;
+                this._icon.style.transform += ` rotate(${angle}deg)`;
+            }
+        },
+        setRotationAngle: function (angle) {
+            this.options.rotationAngle = angle;
+            this.update();
+            return this;
+        }
+    });
+})();
@@ -0,0 +1,98 @@
+// Canvas layer for every vehicle but the active one. All of them are drawn on
+// one <canvas> in a single animation frame however many updates arrive, rather
+// than a DOM marker each.
+// update() takes the batched entries [id, lat, lon, hdg, alt, last_time].
+L.VehicleLayer = L.Layer.extend({
+    options: {
+        color: '#1565c0',
+        staleColor: '#9e9e9e',
+        staleAfter: 5, // seconds without telemetry
+        size: 10,
+    },
+
+    initialize: function (options) {
+        L.setOptions(this, options);
+        this._vehicles = new Map();
+        this._frame = null;
+    },
+
+    onAdd: function (map) {
+        // leaflet-zoom-hide: Leaflet hides it during the zoom animation, it is redrawn after
+        this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+        this._canvas.style.pointerEvents = 'none';
+        map.getPanes().overlayPane.appendChild(this._canvas);
+        map.on('moveend resize', this._reset, this);
+        this._reset();
+    },
+
+    onRemove: function (map) {
+        map.off('moveend resize', this._reset, this);
+        L.DomUtil.remove(this._canvas);
+        if (this._frame) L.Util.cancelAnimFrame(this._frame);
+        this._frame = null;
+    },
+
+    update: function (entries) {
+        for (const entry of entries) this._vehicles.set(entry[0], entry);
+        this._schedule();
+    },
+
+    removeVehicle: function (id) {
+        if (this._vehicles.delete(id)) this._schedule();
+    },
+
+    _schedule: function () {
+        if (this._map && !this._frame) {
+            this._frame = L.Util.requestAnimFrame(this._draw, this);
+        }
+    },
+
+    _reset: function () {
+        const size = this._map.getSize();
+        const ratio = window.devicePixelRatio || 1;
+        L.DomUtil.setPosition(this._canvas, this._map.containerPointToLayerPoint([0, 0]));
+        this._canvas.width = size.x * ratio;
+        this._canvas.height = size.y * ratio;
+        this._canvas.style.width = size.x + 'px';
+        this._canvas.style.height = size.y + 'px';
+        this._ratio = ratio;
+        this._draw();
+    },
+
+    _draw: function () {
+        this._frame = null;
+        const map = this._map;
+        const ctx = this._canvas.getContext('2d');
+        const width = this._canvas.width / this._ratio;
+        const height = this._canvas.height / this._ratio;
+        const size = this.options.size;
+        const now = Date.now() / 1000;
+        ctx.setTransform(this._ratio, 0, 0, this._ratio, 0, 0);
+        ctx.clearRect(0, 0, width, height);
+        ctx.font = '11px sans-serif';
+        ctx.lineWidth = 1.5;
+        ctx.strokeStyle = '#fff';
+        for (const [id, lat, lon, hdg, alt, lastTime] of this._vehicles.values()) {
+            const p = map.latLngToContainerPoint([lat, lon]);
+            if (p.x < -size || p.y < -size || p.x > width + size || p.y > height + size) continue;
+            ctx.fillStyle = now - lastTime > this.options.staleAfter ? this.options.staleColor : this.options.color;
+            ctx.save();
+            ctx.translate(p.x, p.y);
+            ctx.rotate(hdg * Math.PI / 180);
+            ctx.beginPath();
+            ctx.moveTo(0, -size);
+            ctx.lineTo(size * 0.7, size);
+            ctx.lineTo(0, size * 0.5);
+            ctx.lineTo(-size * 0.7, size);
+            ctx.closePath();
+            ctx.fill();
+            ctx.stroke();
+            ctx.restore();
+            ctx.fillText(id, p.x + size + 2, p.y + 4);
+        }
+    },
+});
+
+L.vehicleLayer = function (options) {
+    return new L.VehicleLayer(options);
+};
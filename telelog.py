@@ -0,0 +1,91 @@
+# telelog.py
+# Telemetry log sink. The telemetry thread only queues (formatter, args), the
+# text is built and written on a background thread in batches, either to
+# stdout or to a buffer the GUI terminal drains on its own timer.
+import collections
+import queue
+import sys
+import threading
+import time
+from shared_data import shared_data
+
+
+class TelemetryLog():
+    def __init__(self, maxsize=10000, batch=200, gui_lines=5000):
+        self.queue = queue.Queue(maxsize)
+        self.batch = batch
+        self.gui_lines = collections.deque(maxlen=gui_lines)
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.last_logged = {}
+        self.counters = {}
+        self.dropped = 0 # queue full
+        self.suppressed = 0 # rate limit / sampling
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.drain, daemon=True)
+                self.thread.start()
+
+    def allowed(self, kind):
+        # Per kind sampling (1 in N) and rate limit (lines per second)
+        sample = shared_data.log_sample.get(kind)
+        if sample:
+            n = self.counters.get(kind, 0)
+            self.counters[kind] = n + 1
+            if n % sample:
+                return False
+        rate = shared_data.log_rate_limits.get(kind)
+        if rate:
+            now = time.monotonic()
+            if now - self.last_logged.get(kind, 0) < 1.0 / rate:
+                return False
+            self.last_logged[kind] = now
+        return True
+
+    def log(self, kind, formatter, *args):
+        # kind is a PacketsTypes value or a string such as "crc error"
+        # args must not reference buffers that get reused, copy frame views first
+        if not self.allowed(kind):
+            self.suppressed += 1
+            return
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((formatter, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for formatter, args in items:
+                try:
+                    lines.append(formatter(*args))
+                except Exception as e:
+                    lines.append(f"log format error: {e!r}")
+            if shared_data.log_output == "terminal":
+                self.gui_lines.extend(lines)
+            else:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+    def take_lines(self):
+        # Called from the Qt thread, returns everything buffered for the terminal widget
+        lines = []
+        while self.gui_lines:
+            lines.append(self.gui_lines.popleft())
+        return lines
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped, 'suppressed': self.suppressed}
+
+
+telemetry_log = TelemetryLog()
@@ -4,11 +4,20 @@ import random
 import time
 import serial
 import math
+import struct
+from collections import namedtuple
 from shared_data import shared_data
+from telelog import telemetry_log
+import geospatial
 from enum import IntEnum
 
 
 CRSF_SYNC = 0xC8
+# Address bytes a frame may start with: flight controller (same as SYNC),
+# radio transmitter, receiver, CRSF transmitter module
+CRSF_ADDRESSES = (CRSF_SYNC, 0xEA, 0xEC, 0xEE)
+CRSF_FRAME_MIN = 4
+CRSF_FRAME_MAX = 64
 
 class PacketsTypes(IntEnum):
     GPS = 0x02
@@ -35,15 +44,35 @@ def crc8_dvb_s2(crc, a) -> int:
       crc = crc << 1
   return crc & 0xFF
 
+# crc8_dvb_s2 folded into a lookup table, one entry per input byte
+CRC8_TABLE = bytes(crc8_dvb_s2(0, i) for i in range(256))
+
 def crc8_data(data) -> int:
     crc = 0
+    table = CRC8_TABLE
     for a in data:
-        crc = crc8_dvb_s2(crc, a)
+        crc = table[crc ^ a]
     return crc
 
 def crsf_validate_frame(frame) -> bool:
+    # frame can be bytes, bytearray or a memoryview into a larger buffer,
+    # slicing the memoryview does not copy the payload
+    frame = memoryview(frame)
     return crc8_data(frame[2:-1]) == frame[-1]
 
+def crsf_validate_frames(frames) -> list:
+    # Batch version of crsf_validate_frame for replayed captures etc.
+    # Returns one bool per frame, in order
+    table = CRC8_TABLE
+    results = []
+    for frame in frames:
+        frame = memoryview(frame)
+        crc = 0
+        for a in frame[2:-1]:
+            crc = table[crc ^ a]
+        results.append(crc == frame[-1])
+    return results
+
 def signed_byte(b):
     return b - 256 if b >= 128 else b
 
@@ -81,143 +110,405 @@ def channelsCrsfToChannelsPacket(channels) -> bytes:
     result.append(crc8_data(result[2:]))
     return result
 
-def handleCrsfPacket(ptype, data):
-    if ptype == PacketsTypes.RADIO_ID and data[5] == 0x10:
+class CrsfFramer():
+    # Splits a CRSF byte stream into frames using a fixed size buffer.
+    # Frames are handed out as memoryviews into the buffer, they are only
+    # valid until the feed() generator is advanced again, copy them if needed.
+    def __init__(self, capacity=4096, on_error=None):
+        if capacity < CRSF_FRAME_MAX * 2:
+            raise ValueError('CrsfFramer capacity too small')
+        self.capacity = capacity
+        self.on_error = on_error # called with the rejected frame view on crc error
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.tail = 0
+        self.resyncing = False
+        self.frames = 0
+        self.crc_errors = 0
+        self.bytes_received = 0
+        self.bytes_discarded = 0
+        self.frames_recovered = 0
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'crc_errors': self.crc_errors,
+            'bytes_received': self.bytes_received,
+            'bytes_discarded': self.bytes_discarded,
+            'frames_recovered': self.frames_recovered,
+        }
+
+    def reset(self):
+        self.head = 0
+        self.tail = 0
+        self.resyncing = False
+
+    def write(self, data) -> int:
+        # Copy as much of data as fits, returns the number of bytes taken
+        pending = self.tail - self.head
+        if pending == 0:
+            self.head = self.tail = 0
+        elif self.capacity - self.tail < len(data) and self.head > 0:
+            # Only the unparsed remainder moves back to the start, at most one partial frame
+            self.view[0:pending] = self.view[self.head:self.tail]
+            self.head = 0
+            self.tail = pending
+        n = min(len(data), self.capacity - self.tail)
+        self.view[self.tail:self.tail + n] = data[:n]
+        self.tail += n
+        self.bytes_received += n
+        return n
+
+    def discard(self):
+        # Drop the current start byte and skip ahead to the next possible address byte
+        buf = self.buffer
+        nxt = self.tail
+        for addr in CRSF_ADDRESSES:
+            i = buf.find(addr, self.head + 1, nxt)
+            if i >= 0:
+                nxt = i
+        self.bytes_discarded += nxt - self.head
+        self.head = nxt
+        self.resyncing = True
+
+    def parse(self):
+        buf = self.buffer
+        table = CRC8_TABLE
+        while self.tail - self.head >= 2:
+            head = self.head
+            if buf[head] not in CRSF_ADDRESSES:
+                self.discard()
+                continue
+            expected_len = buf[head + 1] + 2
+            if expected_len > CRSF_FRAME_MAX or expected_len < CRSF_FRAME_MIN:
+                self.discard()
+                continue
+            end = head + expected_len
+            if end > self.tail:
+                break
+            crc = 0
+            for a in self.view[head + 2:end - 1]:
+                crc = table[crc ^ a]
+            frame = self.view[head:end]
+            if crc != buf[end - 1]:
+                self.crc_errors += 1
+                if self.on_error is not None:
+                    self.on_error(frame)
+                self.discard()
+                continue
+            self.head = end
+            self.frames += 1
+            if self.resyncing:
+                self.frames_recovered += 1
+                self.resyncing = False
+            yield frame
+
+    def feed(self, data):
+        # Generator yielding every complete valid frame once data is added
+        data = memoryview(data)
+        while True:
+            n = self.write(data)
+            data = data[n:]
+            yield from self.parse()
+            if not data:
+                break
+
+def unpackCrsfFromBytes(data) -> list:
+    # Inverse of packCrsfToBytes: 22 bytes -> 16 channels of 11 bits
+    bits = int.from_bytes(data, byteorder='little')
+    return [(bits >> shift) & 0x7FF for shift in range(0, 176, 11)]
+
+# Decoded frames, consumers (UI state, recorders, loggers) only see these
+GpsRecord = namedtuple('GpsRecord', ['lat', 'lon', 'gspd', 'hdg', 'alt', 'sats'])
+AttitudeRecord = namedtuple('AttitudeRecord', ['pitch', 'roll', 'yaw'])
+BatteryRecord = namedtuple('BatteryRecord', ['vbat', 'curr', 'mah', 'pct'])
+LinkStatsRecord = namedtuple('LinkStatsRecord', ['rssi1', 'rssi2', 'lq', 'snr', 'antenna', 'mode', 'power',
+                                                 'downlink_rssi', 'downlink_lq', 'downlink_snr'])
+VarioRecord = namedtuple('VarioRecord', ['vspd'])
+BaroAltRecord = namedtuple('BaroAltRecord', ['alt'])
+FlightModeRecord = namedtuple('FlightModeRecord', ['flightmode'])
+RcChannelsRecord = namedtuple('RcChannelsRecord', ['channels'])
+
+# Payload layouts, all big endian, payload starts at frame[3]
+GPS_STRUCT = struct.Struct('>iiHHHB') # lat, lon int32; ground speed, heading, altitude uint16; sats
+ATTITUDE_STRUCT = struct.Struct('>hhh')
+BATTERY_STRUCT = struct.Struct('>hhBHB') # mAh is 24 bit, split into high byte + low word
+LINK_STATISTICS_STRUCT = struct.Struct('>bbBbBBBbBb')
+VARIO_STRUCT = struct.Struct('>h')
+BARO_ALT_STRUCT = struct.Struct('>i')
+
+def decode_gps(data):
+    lat, lon, gspd, hdg, alt, sats = GPS_STRUCT.unpack_from(data, 3)
+    return GpsRecord(lat / 1e7, lon / 1e7, gspd / 36.0, hdg / 100.0, alt - 1000, sats)
+
+def decode_attitude(data):
+    pitch, roll, yaw = ATTITUDE_STRUCT.unpack_from(data, 3)
+    return AttitudeRecord(pitch / 10000.0, roll / 10000.0, yaw / 10000.0)
+
+def decode_battery(data):
+    vbat, curr, mah_hi, mah_lo, pct = BATTERY_STRUCT.unpack_from(data, 3)
+    return BatteryRecord(vbat / 10.0, curr / 10.0, mah_hi << 16 | mah_lo, pct)
+
+def decode_link_statistics(data):
+    return LinkStatsRecord._make(LINK_STATISTICS_STRUCT.unpack_from(data, 3))
+
+def decode_vario(data):
+    return VarioRecord(VARIO_STRUCT.unpack_from(data, 3)[0] / 10.0)
+
+def decode_baro_alt(data):
+    return BaroAltRecord(BARO_ALT_STRUCT.unpack_from(data, 3)[0] / 100.0)
+
+def decode_flight_mode(data):
+    # Null terminated string between type byte and crc
+    return FlightModeRecord(bytes(data[3:-1]).split(b'\x00', 1)[0].decode('ascii', 'replace'))
+
+def decode_rc_channels(data):
+    return RcChannelsRecord(unpackCrsfFromBytes(data[3:25]))
+
+CRSF_DECODERS = {
+    PacketsTypes.GPS: decode_gps,
+    PacketsTypes.ATTITUDE: decode_attitude,
+    PacketsTypes.BATTERY_SENSOR: decode_battery,
+    PacketsTypes.LINK_STATISTICS: decode_link_statistics,
+    PacketsTypes.VARIO: decode_vario,
+    PacketsTypes.BARO_ALT: decode_baro_alt,
+    PacketsTypes.FLIGHT_MODE: decode_flight_mode,
+    PacketsTypes.RC_CHANNELS_PACKED: decode_rc_channels,
+}
+
+def decodeCrsfPacket(ptype, data):
+    # Returns a record, or None for frame types without a decoder
+    # Raises struct.error if the payload is too short for its type
+    decoder = CRSF_DECODERS.get(ptype)
+    if decoder is None:
+        return None
+    return decoder(data)
+
+# Appliers turn a record into the TelemetryState fields it changes
+def apply_gps(rec):
+    pos = geospatial.GPSposition(rec.lat, rec.lon, rec.alt)
+    return {'got_gps': True, 'pos_uav': pos, 'gspd': rec.gspd, 'hdg': rec.hdg, 'sats': rec.sats}
+
+def apply_attitude(rec):
+    return {'pitch': rec.pitch, 'roll': rec.roll, 'yaw': rec.yaw}
+
+def apply_battery(rec):
+    return {'vbat': rec.vbat, 'curr': rec.curr, 'mah': rec.mah, 'pct': rec.pct}
+
+def apply_link_statistics(rec):
+    return {'rssi1': rec.rssi1, 'rssi2': rec.rssi2, 'lq': rec.lq, 'snr': rec.snr, 'mode': rec.mode}
+
+def apply_vario(rec):
+    return {'vspd': rec.vspd}
+
+def apply_baro_alt(rec):
+    return {'baro_alt': rec.alt}
+
+def apply_flight_mode(rec):
+    return {'flightmode': rec.flightmode}
+
+def apply_rc_channels(rec):
+    return None
+
+RECORD_APPLIERS = {
+    GpsRecord: apply_gps,
+    AttitudeRecord: apply_attitude,
+    BatteryRecord: apply_battery,
+    LinkStatsRecord: apply_link_statistics,
+    VarioRecord: apply_vario,
+    BaroAltRecord: apply_baro_alt,
+    FlightModeRecord: apply_flight_mode,
+    RcChannelsRecord: apply_rc_channels,
+}
+
+def applyCrsfRecord(rec, timestamp=None, vehicle=None):
+    # Publishes a decoded record as one new state of the vehicle (None: the active one)
+    # timestamp is the frame arrival time (time.time()), defaults to now
+    changes = RECORD_APPLIERS[type(rec)](rec)
+    if changes is not None:
+        changes['last_time_telemetry'] = time.time() if timestamp is None else timestamp
+        shared_data.publish(vehicle, **changes)
+        if 'pos_uav' in changes:
+            shared_data.track_of(vehicle).append(changes['pos_uav'])
+
+# Log text, built on the telelog thread rather than the reader thread
+def format_gps(rec):
+    return f"GPS: Pos={rec.lat} {rec.lon} GSpd={rec.gspd:0.1f}m/s Hdg={rec.hdg:0.1f} Alt={rec.alt}m Sats={rec.sats}"
+
+def format_attitude(rec):
+    return f"Attitude: Pitch={rec.pitch:0.2f} Roll={rec.roll:0.2f} Yaw={rec.yaw:0.2f} (rad)"
+
+def format_battery(rec):
+    return f"Battery: {rec.vbat:0.2f}V {rec.curr:0.1f}A {rec.mah}mAh {rec.pct}%"
+
+def format_link_statistics(rec):
+    return f"RSSI={rec.rssi1}/{rec.rssi2}dBm LQ={rec.lq:03} mode={rec.mode}" # ant={antenna} snr={snr} power={power} drssi={downlink_rssi} dlq={downlink_lq} dsnr={downlink_snr}"
+
+def format_vario(rec):
+    return f"VSpd: {rec.vspd:0.1f}m/s"
+
+def format_baro_alt(rec):
+    return f"Baro Altitude: {rec.alt}m"
+
+def format_flight_mode(rec):
+    return f"Flight Mode: {rec.flightmode}"
+
+def format_frame(label, frame):
+    packet = ' '.join(map(hex, frame))
+    return f"{label}: {packet}"
+
+RECORD_FORMATTERS = {
+    GpsRecord: format_gps,
+    AttitudeRecord: format_attitude,
+    BatteryRecord: format_battery,
+    LinkStatsRecord: format_link_statistics,
+    VarioRecord: format_vario,
+    BaroAltRecord: format_baro_alt,
+    FlightModeRecord: format_flight_mode,
+}
+
+def handleCrsfPacket(ptype, data, timestamp=None, vehicle=None):
+    try:
+        rec = decodeCrsfPacket(ptype, data)
+    except struct.error:
+        telemetry_log.log("short", format_frame, f"Short 0x{ptype:02x}", bytes(data))
+        return
+
+    if rec is not None:
+        applyCrsfRecord(rec, timestamp, vehicle)
+        if shared_data.printtele and type(rec) in RECORD_FORMATTERS:
+            telemetry_log.log(ptype, RECORD_FORMATTERS[type(rec)], rec)
+
+    elif ptype == PacketsTypes.RADIO_ID and data[5] == 0x10:
         #print(f"OTX sync")
         pass
-    elif ptype == PacketsTypes.LINK_STATISTICS:
-        shared_data.rssi1 = signed_byte(data[3])
-        shared_data.rssi2 = signed_byte(data[4])
-        shared_data.lq = data[5]
-        shared_data.snr = signed_byte(data[6])
-        antenna = data[7]
-        shared_data.mode = data[8]
-        power = data[9]
-        # telemetry strength
-        downlink_rssi = signed_byte(data[10])
-        downlink_lq = data[11]
-        downlink_snr = signed_byte(data[12])
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"RSSI={shared_data.rssi1}/{shared_data.rssi2}dBm LQ={shared_data.lq:03} mode={shared_data.mode}") # ant={antenna} snr={snr} power={power} drssi={downlink_rssi} dlq={downlink_lq} dsnr={downlink_snr}")
-    
-    elif ptype == PacketsTypes.ATTITUDE:
-        shared_data.pitch = int.from_bytes(data[3:5], byteorder='big', signed=True) / 10000.0
-        shared_data.roll = int.from_bytes(data[5:7], byteorder='big', signed=True) / 10000.0
-        shared_data.yaw = int.from_bytes(data[7:9], byteorder='big', signed=True) / 10000.0
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"Attitude: Pitch={shared_data.pitch:0.2f} Roll={shared_data.roll:0.2f} Yaw={shared_data.yaw:0.2f} (rad)")
-
-    elif ptype == PacketsTypes.FLIGHT_MODE:
-        shared_data.flightmode = ''.join(map(chr, data[3:-2]))
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"Flight Mode: {shared_data.flightmode}")
-
-    elif ptype == PacketsTypes.BATTERY_SENSOR:
-        shared_data.vbat = int.from_bytes(data[3:5], byteorder='big', signed=True) / 10.0
-        shared_data.curr = int.from_bytes(data[5:7], byteorder='big', signed=True) / 10.0
-        shared_data.mah = data[7] << 16 | data[8] << 7 | data[9]
-        shared_data.pct = data[10]
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"Battery: {shared_data.vbat:0.2f}V {shared_data.curr:0.1f}A {shared_data.mah}mAh {shared_data.pct}%")
-
-    elif ptype == PacketsTypes.BARO_ALT:
-        shared_data.baro_alt = int.from_bytes(data[3:7], byteorder='big', signed=True) / 100.0
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"Baro Altitude: {shared_data.baro_alt}m")
 
     elif ptype == PacketsTypes.DEVICE_INFO:
-        packet = ' '.join(map(hex, data))
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"Device Info: {packet}")
-
-    elif data[2] == PacketsTypes.GPS:
-        shared_data.got_gps = True
-        shared_data.pos_uav.lat = int.from_bytes(data[3:7], byteorder='big', signed=True) / 1e7
-        shared_data.pos_uav.lon = int.from_bytes(data[7:11], byteorder='big', signed=True) / 1e7
-        shared_data.gspd = int.from_bytes(data[11:13], byteorder='big', signed=True) / 36.0
-        shared_data.hdg =  int.from_bytes(data[13:15], byteorder='big', signed=True) / 100.0
-        shared_data.pos_uav.alt = int.from_bytes(data[15:17], byteorder='big', signed=True) - 1000
-        shared_data.log_pos.append(shared_data.pos_uav)
-        shared_data.sats = data[17]
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"GPS: Pos={shared_data.pos_uav.lat} {shared_data.pos_uav.lon} GSpd={shared_data.gspd:0.1f}m/s Hdg={shared_data.hdg:0.1f} Alt={shared_data.pos_uav.alt}m Sats={shared_data.sats}")
-
-    elif ptype == PacketsTypes.VARIO:
-        shared_data.vspd = int.from_bytes(data[3:5], byteorder='big', signed=True) / 10.0
-        shared_data.last_time_telemetry = time.time()
-        if shared_data.printtele: print(f"VSpd: {shared_data.vspd:0.1f}m/s")
-
-    elif ptype == PacketsTypes.RC_CHANNELS_PACKED:
-        #print(f"Channels: (data)")
-        pass
+        shared_data.publish(vehicle, last_time_telemetry=time.time() if timestamp is None else timestamp)
+        if shared_data.printtele: telemetry_log.log(ptype, format_frame, "Device Info", bytes(data))
 
     else:
-        packet = ' '.join(map(hex, data))
-        print(f"Unknown 0x{ptype:02x}: {packet}")
+        telemetry_log.log("unknown", format_frame, f"Unknown 0x{ptype:02x}", bytes(data))
+
+
+def crsf_crc_error(frame):
+    telemetry_log.log("crc error", format_frame, "crc error", bytes(frame))
+
+def serial_read_poll(ser):
+    # Legacy mode: check the port every 20ms
+    if ser.in_waiting > 0:
+        return ser.read(ser.in_waiting)
+    #if args.tx:
+    #    ser.write(channelsCrsfToChannelsPacket([992 for ch in range(16)]))
+    time.sleep(0.020)
+    return b''
+
+def serial_read_blocking(ser):
+    # Sleeps in the driver until at least one byte arrives (or the port
+    # timeout expires), then takes whatever else is already queued
+    return ser.read(max(1, ser.in_waiting))
 
+SERIAL_READERS = {
+    "blocking": serial_read_blocking,
+    "poll": serial_read_poll,
+}
 
 def crsf_telemetry(app):
 
-    with serial.Serial(shared_data.telem_port, shared_data.telem_baud, timeout=2) as ser:
-        input_buffer = bytearray()
+    with serial.Serial(shared_data.telem_port, shared_data.telem_baud, timeout=1) as ser:
+        # The framer resyncs on address bytes instead of dropping the
+        # whole buffer when a length byte is bad, and validates the CRC
+        framer = CrsfFramer(on_error=crsf_crc_error)
+        shared_data.crsf_framer = framer
+        read = SERIAL_READERS[shared_data.telem_read_mode]
         while True:
-            if ser.in_waiting > 0:
-                input_buffer.extend(ser.read(ser.in_waiting))
-            else:
-                #if args.tx:
-                #    ser.write(channelsCrsfToChannelsPacket([992 for ch in range(16)]))
-                time.sleep(0.020)
-
-            while len(input_buffer) > 2:
-                # This simple parser works with malformed CRSF streams
-                # it does not check the first byte for SYNC_BYTE, but
-                # instead just looks for anything where the packet length
-                # is 4-64 bytes, and the CRC validates
-                expected_len = input_buffer[1] + 2
-                if expected_len > 64 or expected_len < 4:
-                    input_buffer = bytearray()
-                elif len(input_buffer) >= expected_len:
-                    single = input_buffer[:expected_len] # copy out this whole packet
-                    input_buffer = input_buffer[expected_len:] # and remove it from the buffer
-
-                    if not crsf_validate_frame(single): # single[-1] != crc:
-                        packet = ' '.join(map(hex, single))
-                        print(f"crc error: {packet}")
-                    else:
-                        handleCrsfPacket(single[2], single)
-                else:
-                    break
+            data = read(ser)
+            if not data:
+                continue
+            # Frames completed by this read all arrived now
+            timestamp = time.time()
+            for frame in framer.feed(data):
+                if shared_data.recorder is not None:
+                    shared_data.recorder.record(timestamp, "serial", frame)
+                handleCrsfPacket(frame[2], frame, timestamp)
 
 def dummy_telemetry(app):
     while True:
-        shared_data.flightmode = "ANGLE" if random.random() > 0.5 else "HORIZON"
+        s = shared_data.snapshot()
+        pos = geospatial.GPSposition(s.pos_uav.lat + random.uniform(-0.001, 0.001),  # Update latitude
+                                     s.pos_uav.lon + random.uniform(-0.001, 0.001),  # Update longitude
+                                     s.pos_uav.alt + random.randint(1, 2))
+        vbat = s.vbat - 0.01
         shared_data.speed = random.randint(100, 300)
-        shared_data.pitch = random.uniform(-1, 1)
-        shared_data.roll = random.uniform(-1, 1)
-        shared_data.pos_uav.lat += random.uniform(-0.001, 0.001)  # Update latitude
-        shared_data.pos_uav.lon += random.uniform(-0.001, 0.001)  # Update longitude
-        shared_data.pos_uav.alt += random.randint(1, 2)
-        shared_data.baro_alt = shared_data.pos_uav.alt
-        shared_data.vbat -= 0.01
-        shared_data.mah = round(5000.0 * (((shared_data.vbat/shared_data.scells)-3.5) / 0.7),1)
-        shared_data.pct = round(100.0 * (((shared_data.vbat/shared_data.scells)-3.5) / 0.7),2)
-        shared_data.yaw += random.randint(-5, 5)
-        shared_data.lq = random.randint(0, 100)
-        shared_data.rssi1 = random.uniform(-110, -10)
-        shared_data.last_time_telemetry = time.time()
+        shared_data.publish(
+            flightmode = "ANGLE" if random.random() > 0.5 else "HORIZON",
+            pitch = random.uniform(-1, 1),
+            roll = random.uniform(-1, 1),
+            pos_uav = pos,
+            baro_alt = pos.alt,
+            vbat = vbat,
+            mah = round(5000.0 * (((vbat/shared_data.scells)-3.5) / 0.7),1),
+            pct = round(100.0 * (((vbat/shared_data.scells)-3.5) / 0.7),2),
+            yaw = s.yaw + random.randint(-5, 5),
+            lq = random.randint(0, 100),
+            rssi1 = random.uniform(-110, -10),
+            last_time_telemetry = time.time(),
+        )
+        shared_data.track_of(None).append(pos) # as applyCrsfRecord does for real GPS frames
         time.sleep(1)
 
+def simulated_fleet(count, rate):
+    # count vehicles flying circles around the start position, each updated rate times a second
+    center = shared_data.snapshot().pos_uav
+    vehicles = [(f"sim{n}", random.uniform(200, 3000), random.uniform(0, 2 * math.pi), random.uniform(10, 30))
+                for n in range(count)]
+    start = time.time()
+    while True:
+        now = time.time()
+        for vehicle, radius, phase, speed in vehicles:
+            angle = phase + speed * (now - start) / radius
+            east, north = radius * math.cos(angle), radius * math.sin(angle)
+            pos = geospatial.GPSposition(center.lat + north / 111320.0,
+                                         center.lon + east / (111320.0 * math.cos(math.radians(center.lat))), 100)
+            shared_data.publish(vehicle,
+                got_gps = True,
+                pos_uav = pos,
+                gspd = speed,
+                hdg = math.degrees(-angle) % 360, # counterclockwise flight
+                last_time_telemetry = now,
+            )
+            if shared_data.sim_vehicle_tracks:
+                shared_data.track_of(vehicle).append(pos)
+        time.sleep(max(0.0, 1.0 / rate - (time.time() - now)))
+
 def start_data_thread(app):
+    if shared_data.record_path and shared_data.telemetry not in ("random", "replay"):
+        from recorder import start_recorder
+        shared_data.recorder = start_recorder(shared_data.record_path)
+
     if shared_data.telemetry == "random":
-        threading.Thread(target=dummy_telemetry, args=(app,), daemon=True).start()
         shared_data.video_source = "video.mp4"
-        shared_data.pos_uav.lat = 36.52982407028365
-        shared_data.pos_uav.lon = -83.21680266631701
-        shared_data.pos_uav.alt = random.randint(50, 500)
-        shared_data.vbat = 12.6
-        shared_data.mah = 5000.0
-        shared_data.pct = 100
-        shared_data.got_gps = True
+        shared_data.publish(
+            pos_uav = geospatial.GPSposition(36.52982407028365, -83.21680266631701, random.randint(50, 500)),
+            vbat = 12.6,
+            mah = 5000.0,
+            pct = 100,
+            got_gps = True,
+        )
+        threading.Thread(target=dummy_telemetry, args=(app,), daemon=True).start()
+        if shared_data.sim_vehicles:
+            threading.Thread(target=simulated_fleet, args=(shared_data.sim_vehicles, shared_data.sim_vehicle_rate),
+                             daemon=True).start()
 
     elif shared_data.telemetry == "crsf":
         threading.Thread(target=crsf_telemetry, args=(app,), daemon=True).start()
+
+    elif shared_data.telemetry == "hub":
+        # Several sources in one asyncio loop, see transport.py
+        from transport import start_telemetry_hub
+        start_telemetry_hub(shared_data.telem_sources)
+
+    elif shared_data.telemetry == "replay":
+        from replay import start_replay
+        start_replay(shared_data.replay_path, shared_data.replay_speed, shared_data.replay_loop)
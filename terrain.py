@@ -0,0 +1,207 @@
+# terrain.py
+# Terrain elevation from SRTM .hgt tiles on disk (e.g. N36W084.hgt, 1x1 degree,
+# 1 or 3 arc-second), for AGL altitude and for where a camera ray or a line of
+# sight meets the ground. Tiles are memory-mapped, so only the pages around
+# the queried points are ever read, and a few of them stay mapped in an LRU.
+# Heights are meters above mean sea level, like the altitude in CRSF GPS frames.
+import collections
+import math
+import os
+import threading
+import numpy as np
+import geospatial
+from shared_data import shared_data
+
+VOID = -32768 # no data marker in .hgt files
+RAY_STEP = 10.0 # meters between samples along rays, about a third of a 1" cell
+MAX_RAY_RANGE = 20000.0 # meters
+
+
+def tile_name(lat, lon):
+    # Name of the tile whose south-west corner is lat, lon (integers)
+    return f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}{'E' if lon >= 0 else 'W'}{abs(lon):03d}.hgt"
+
+
+class HgtTile():
+    # Samples sit on the grid lines, row 0 on the north edge, edges shared with neighbours
+    def __init__(self, path, lat, lon):
+        samples = int(round(math.sqrt(os.path.getsize(path) // 2)))
+        if samples * samples * 2 != os.path.getsize(path):
+            raise ValueError(f"{path} is not a square .hgt tile")
+        self.path = path
+        self.lat = lat
+        self.lon = lon
+        self.cells = samples - 1
+        self.data = np.memmap(path, dtype='>i2', mode='r', shape=(samples, samples))
+
+    def sample(self, lat, lon):
+        # Bilinear height at one point, None over voids
+        n = self.cells
+        y = (self.lat + 1 - lat) * n
+        x = (lon - self.lon) * n
+        row = min(max(int(y), 0), n - 1)
+        col = min(max(int(x), 0), n - 1)
+        fy = y - row
+        fx = x - col
+        data = self.data
+        total = weight = 0.0
+        for h, w in ((data[row, col], (1 - fy) * (1 - fx)), (data[row, col + 1], (1 - fy) * fx),
+                     (data[row + 1, col], fy * (1 - fx)), (data[row + 1, col + 1], fy * fx)):
+            if h != VOID:
+                total += float(h) * w
+                weight += w
+        # Voids next to the point are left out and the rest reweighted
+        return total / weight if weight > 0 else None
+
+    def samples(self, lats, lons):
+        # Arrays of points in this tile -> heights, NaN over voids
+        n = self.cells
+        y = (self.lat + 1 - lats) * n
+        x = (lons - self.lon) * n
+        row = np.clip(y.astype(np.intp), 0, n - 1)
+        col = np.clip(x.astype(np.intp), 0, n - 1)
+        fy = y - row
+        fx = x - col
+        heights = np.stack([self.data[row, col], self.data[row, col + 1],
+                            self.data[row + 1, col], self.data[row + 1, col + 1]]).astype(float)
+        weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx])
+        weights[heights == VOID] = 0.0
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, (heights * weights).sum(axis=0) / total, np.nan)
+
+
+class TerrainModel():
+    def __init__(self, path, max_tiles=8):
+        self.path = path
+        self.max_tiles = max_tiles
+        self.lock = threading.Lock()
+        self.tiles = collections.OrderedDict() # (lat, lon) of the south-west corner -> HgtTile
+        self.missing = set() # tiles with no file, not looked up again until clear()
+        self.loads = 0
+
+    def tile(self, key):
+        # Called from the UI and Flask threads, the LRU is only touched under the lock
+        if key in self.missing:
+            return None
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            else:
+                path = self.find(*key)
+                if path is None:
+                    self.missing.add(key)
+                    return None
+                tile = self.tiles[key] = HgtTile(path, *key)
+                self.loads += 1
+                while len(self.tiles) > self.max_tiles:
+                    self.tiles.popitem(last=False)
+            return tile
+
+    def find(self, lat, lon):
+        name = tile_name(lat, lon)
+        for candidate in (name, name.lower()):
+            path = os.path.join(self.path, candidate)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def clear(self):
+        # Forget mapped and missing tiles, e.g. after adding files
+        with self.lock:
+            self.tiles.clear()
+            self.missing.clear()
+
+    def elevation(self, lat, lon):
+        # Meters above sea level at one point, None without data
+        tile = self.tile((math.floor(lat), math.floor(lon)))
+        return None if tile is None else tile.sample(lat, lon)
+
+    def elevations(self, lats, lons):
+        # Arrays of points -> array of heights, NaN without data
+        lats, lons = np.broadcast_arrays(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+        result = np.full(lats.shape, np.nan)
+        keys = np.stack([np.floor(lats), np.floor(lons)], axis=-1).reshape(-1, 2)
+        flat_lats, flat_lons, flat_result = lats.reshape(-1), lons.reshape(-1), result.reshape(-1)
+        for key in np.unique(keys, axis=0):
+            tile = self.tile((int(key[0]), int(key[1])))
+            if tile is None:
+                continue
+            mask = (keys[:, 0] == key[0]) & (keys[:, 1] == key[1])
+            flat_result[mask] = tile.samples(flat_lats[mask], flat_lons[mask])
+        return flat_result.reshape(lats.shape)
+
+    def agl(self, pos):
+        # Height of pos (MSL altitude) above the ground under it, None without data
+        ground = self.elevation(pos.lat, pos.lon)
+        return None if ground is None else pos.alt - ground
+
+    def first_contact(self, frame, east, north, up, clearance=0.0):
+        # Index and fraction along the sampled path of the first point at or
+        # below the ground (+ clearance), None when it stays above or over no data
+        lat, lon, alt = frame.from_enu(east, north, up)
+        above = alt - self.elevations(lat, lon) - clearance
+        below = np.flatnonzero(above <= 0) # NaN compares false, no data never blocks
+        if not len(below):
+            return None
+        i = below[0]
+        if i == 0 or np.isnan(above[i - 1]):
+            return i, 0.0
+        return i - 1, above[i - 1] / (above[i - 1] - above[i])
+
+    def ray_to_ground(self, pos, az, ang, max_range=MAX_RAY_RANGE, step=RAY_STEP):
+        # Where a ray from pos meets the terrain: az from north, ang from straight
+        # down as in geospatial.vector_to_gps_air. None if it doesn't within max_range.
+        frame = geospatial.LocalFrame(pos.lat, pos.lon, pos.alt)
+        s = np.arange(0.0, max_range + step, step)
+        horizontal = s * math.sin(math.radians(ang))
+        east = horizontal * math.sin(math.radians(az))
+        north = horizontal * math.cos(math.radians(az))
+        up = -s * math.cos(math.radians(ang))
+        contact = self.first_contact(frame, east, north, up)
+        if contact is None:
+            return None
+        i, t = contact
+        j = min(i + 1, len(s) - 1)
+        hit = frame.position(east[i] + t * (east[j] - east[i]), north[i] + t * (north[j] - north[i]),
+                             up[i] + t * (up[j] - up[i]))
+        ground = self.elevation(hit.lat, hit.lon)
+        return geospatial.GPSposition(hit.lat, hit.lon, hit.alt if ground is None else ground)
+
+    def line_of_sight(self, pos1, pos2, clearance=0.0, step=RAY_STEP):
+        # (visible, first obstruction as a GPSposition or None) between two MSL positions
+        frame = geospatial.LocalFrame(pos1.lat, pos1.lon, pos1.alt)
+        e2, n2, u2 = frame.enu(pos2.lat, pos2.lon, pos2.alt)
+        length = math.sqrt(e2 * e2 + n2 * n2 + u2 * u2)
+        count = max(2, int(length / step) + 1)
+        f = np.linspace(0.0, 1.0, count)[1:-1] # the end points themselves don't block
+        if not len(f):
+            return True, None
+        contact = self.first_contact(frame, f * e2, f * n2, f * u2, clearance)
+        if contact is None:
+            return True, None
+        i = contact[0]
+        blocked = frame.position(f[i] * e2, f[i] * n2, f[i] * u2)
+        return False, geospatial.GPSposition(blocked.lat, blocked.lon, self.elevation(blocked.lat, blocked.lon))
+
+    def stats(self):
+        return {'mapped': len(self.tiles), 'missing': len(self.missing), 'loads': self.loads}
+
+
+terrain = None
+
+def get_terrain():
+    global terrain
+    if terrain is None:
+        terrain = TerrainModel(shared_data.terrain_path, shared_data.terrain_tiles)
+    return terrain
+
+if __name__ == '__main__':
+    # Ground height at a point: python terrain.py 36.53 -83.22
+    import argparse
+    parser = argparse.ArgumentParser(description="Terrain elevation from the local .hgt tiles")
+    parser.add_argument("lat", type=float)
+    parser.add_argument("lon", type=float)
+    args = parser.parse_args()
+    print(get_terrain().elevation(args.lat, args.lon))
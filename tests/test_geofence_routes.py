@@ -0,0 +1,42 @@
+# /geofence routes: bad zones are 400, unknown ids 404
+import pytest
+import map_server
+from geofence import GeofenceEngine
+from shared_data import shared_data
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(shared_data, 'geofence', GeofenceEngine())
+    return map_server.app.test_client()
+
+
+def test_add_and_remove(client):
+    zone = client.post('/geofence/zone', json={'shape': 'circle', 'lat': 36.53, 'lon': -83.22, 'radius': '500'}).json
+    assert zone['radius'] == 500.0
+    polygon = client.post('/geofence/zone', json={'points': [[36.5, -83.2], [36.6, -83.2], [36.6, -83.1]],
+                                                  'inclusion': True}).json
+    assert polygon['shape'] == 'polygon' and polygon['inclusion']
+    assert len(client.get('/geofence').json['zones']) == 2
+    assert client.post('/geofence/remove', json={'id': zone['id']}).status_code == 200
+
+@pytest.mark.parametrize('zone', [
+    {},
+    {'shape': 'circle', 'lat': 36.53, 'lon': -83.22},
+    {'shape': 'circle', 'lat': 36.53, 'lon': -83.22, 'radius': 'wide'},
+    {'shape': 'circle', 'lat': 'north', 'lon': -83.22, 'radius': 100},
+    {'shape': 'circle', 'lat': 36.53, 'lon': -83.22, 'radius': 'nan'},
+    {'shape': 'circle', 'lat': 36.53, 'lon': -83.22, 'radius': -5},
+    {'points': [[36.5, -83.2], [36.6, -83.2]]},
+    {'points': [[36.5, -83.2], [36.6], [36.6, -83.1]]},
+    {'points': [[36.5, -83.2], [36.6, -83.2], [96.6, -83.1]]},
+    {'points': 3},
+])
+def test_bad_zone(client, zone):
+    assert client.post('/geofence/zone', json=zone).status_code == 400
+    assert shared_data.geofence.zones == {}
+
+def test_remove_bad_or_unknown(client):
+    assert client.post('/geofence/remove', json={}).status_code == 400
+    assert client.post('/geofence/remove', json={'id': 'first'}).status_code == 400
+    assert client.post('/geofence/remove', json={'id': 99}).status_code == 404
@@ -0,0 +1,73 @@
+# /mission routes: bad requests are 400, unknown ids 404, never a 500
+import pytest
+import map_server
+from mission import MissionStore
+from shared_data import shared_data
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(shared_data, 'mission', MissionStore())
+    return map_server.app.test_client()
+
+def add(client, **item):
+    response = client.post('/mission/item', json=item)
+    assert response.status_code == 200
+    return response.json
+
+
+def test_add_move_remove(client):
+    wp = add(client, kind='wp', lat=36.53, lon=-83.22, alt=100, name='start')
+    assert wp['kind'] == 'wp' and wp['name'] == 'start'
+    moved = client.post('/mission/move', json={'id': wp['id'], 'lat': 36.54, 'lon': -83.21}).json
+    assert (moved['lat'], moved['lon']) == (36.54, -83.21)
+    assert client.post('/mission/remove', json={'id': wp['id']}).status_code == 200
+    assert client.get('/mission').json['items'] == []
+
+@pytest.mark.parametrize('item', [
+    {},
+    {'kind': 'wp', 'lat': 36.53},
+    {'kind': 'fence', 'lat': 36.53, 'lon': -83.22},
+    {'kind': 'wp', 'lat': 'north', 'lon': -83.22},
+    {'kind': 'wp', 'lat': None, 'lon': -83.22},
+    {'kind': 'wp', 'lat': 91, 'lon': -83.22},
+    {'kind': 'wp', 'lat': 'nan', 'lon': -83.22},
+    {'kind': 'wp', 'lat': 36.53, 'lon': -83.22, 'position': 'first'},
+])
+def test_add_bad_item(client, item):
+    assert client.post('/mission/item', json=item).status_code == 400
+    assert shared_data.mission.items == {}
+
+def test_not_json(client):
+    for path in ('/mission/item', '/mission/move', '/mission/remove', '/mission/next'):
+        assert client.post(path, data="lat=1").status_code == 400
+        assert client.post(path, json=[1, 2]).status_code == 400
+
+@pytest.mark.parametrize('body', [{}, {'id': 1}, {'id': 1, 'lat': 36.5}, {'id': 'one', 'lat': 36.5, 'lon': -83.2},
+                                  {'id': 1, 'lat': 36.5, 'lon': 200}])
+def test_move_bad_request(client, body):
+    add(client, kind='wp', lat=36.53, lon=-83.22)
+    assert client.post('/mission/move', json=body).status_code == 400
+
+def test_unknown_ids(client):
+    assert client.post('/mission/move', json={'id': 99, 'lat': 36.5, 'lon': -83.2}).status_code == 404
+    assert client.post('/mission/remove', json={'id': 99}).status_code == 404
+    assert client.post('/mission/remove', json={}).status_code == 400
+
+def test_next(client):
+    assert client.post('/mission/next', json={}).status_code == 400
+    assert client.post('/mission/next', json={'number': 'two'}).status_code == 400
+    for lat in (36.53, 36.54, 36.55):
+        add(client, kind='wp', lat=lat, lon=-83.22)
+    response = client.post('/mission/next', json={'number': 1})
+    assert response.status_code == 200
+    assert response.json['number'] == 1 and response.json['item']['lat'] == 36.54
+
+def test_clear_and_queries(client):
+    add(client, kind='poi', lat=36.53, lon=-83.22)
+    assert client.post('/mission/clear', json={'kind': 'fence'}).status_code == 400
+    assert client.get('/mission/nearest').status_code == 400
+    assert client.get('/mission/hit?lat=36.53').status_code == 400
+    assert client.get('/mission/nearest?lat=36.53&lon=-83.22').json['kind'] == 'poi'
+    assert client.post('/mission/clear', json={}).status_code == 200
+    assert client.get('/mission').json['items'] == []
@@ -0,0 +1,132 @@
+# Tile cache against a local stand-in for the upstream tile server
+import http.server
+import socket
+import threading
+import time
+import pytest
+import tiles
+import map_server
+from shared_data import shared_data
+
+
+class StandInTiles(http.server.BaseHTTPRequestHandler):
+    # /z/x/y.png -> a body naming the tile, anything else 404
+    requests = []
+
+    def do_GET(self):
+        StandInTiles.requests.append(self.path)
+        parts = self.path.strip('/').removesuffix('.png').split('/')
+        if len(parts) != 3 or not all(part.isdigit() for part in parts):
+            self.send_error(404)
+            return
+        body = f"tile {'/'.join(parts)}".encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def upstream():
+    StandInTiles.requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInTiles)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}" + "/{z}/{x}/{y}.png"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def dead_upstream():
+    # A port nothing listens on, connections are refused at once
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}" + "/{z}/{x}/{y}.png"
+
+@pytest.fixture
+def cache(tmp_path, upstream, monkeypatch):
+    cache = tiles.TileCache(tiles.TileStore(str(tmp_path / "tiles.mbtiles")), upstream)
+    monkeypatch.setattr(tiles, 'tile_cache', cache)
+    monkeypatch.setattr(shared_data, 'tiles_offline', False)
+    yield cache
+    cache.store.close()
+
+@pytest.fixture
+def client():
+    return map_server.app.test_client()
+
+def wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+
+def test_miss_then_hit(cache, client):
+    response = client.get('/tiles/3/2/5.png')
+    assert response.status_code == 200
+    assert response.data == b"tile 3/2/5"
+    # Stored, so offline it is still served without asking upstream
+    shared_data.tiles_offline = True
+    assert client.get('/tiles/3/2/5.png').data == b"tile 3/2/5"
+    assert StandInTiles.requests == ['/3/2/5.png']
+    stats = cache.stats()
+    assert stats['tiles'] == 1 and stats['hits'] == 1
+
+def test_offline_miss_is_404(cache, client):
+    shared_data.tiles_offline = True
+    assert client.get('/tiles/3/2/5.png').status_code == 404
+    assert StandInTiles.requests == []
+
+@pytest.mark.parametrize('path', ['/tiles/40/0/0.png', '/tiles/2/4/0.png', '/tiles/2/0/4.png',
+                                  f'/tiles/{tiles.MAX_ZOOM + 1}/0/0.png'])
+def test_out_of_range_tile_is_404(cache, client, path):
+    assert client.get(path).status_code == 404
+    assert StandInTiles.requests == []
+    assert cache.store.stats()['misses'] == 0
+
+def test_unreachable_upstream_backs_off(cache, client, dead_upstream, monkeypatch):
+    monkeypatch.setattr(shared_data, 'tile_backoff', 30)
+    cache.url_template = dead_upstream
+    assert client.get('/tiles/3/2/5.png').status_code == 404
+    assert cache.upstream_down() and cache.upstream_errors == 1
+    # During the backoff misses are answered without trying again
+    assert client.get('/tiles/3/2/6.png').status_code == 404
+    assert cache.upstream_errors == 1
+    assert client.get('/tiles/stats').json['upstream_down']
+
+def test_http_error_does_not_back_off(cache, upstream):
+    cache.url_template = upstream.replace('{z}', 'z{z}')
+    assert cache.tile(3, 2, 5) is None
+    assert cache.upstream_errors == 1 and not cache.upstream_down()
+
+def test_prefetch(cache):
+    job = tiles.PrefetchJob(cache, (-83.25, 36.50, -83.18, 36.56), range(10, 13))
+    job.run()
+    assert job.fetched == len(job.tiles) == len(StandInTiles.requests)
+    assert job.failed == 0
+    # Everything is in the store now, a second run downloads nothing
+    again = tiles.PrefetchJob(cache, (-83.25, 36.50, -83.18, 36.56), range(10, 13))
+    again.run()
+    assert again.fetched == 0 and again.done == len(again.tiles)
+
+def test_prefetch_resumes_after_backoff(cache, upstream, dead_upstream, monkeypatch):
+    monkeypatch.setattr(shared_data, 'tile_backoff', 0.3)
+    cache.url_template = dead_upstream
+    job = cache.prefetch((-83.25, 36.50, -83.18, 36.56), range(10, 12))
+    wait_for(lambda: job.waiting)
+    cache.url_template = upstream
+    wait_for(lambda: not job.running)
+    assert job.fetched == len(job.tiles) and job.failed == 0
+
+def test_prefetch_cap(cache, client):
+    with pytest.raises(ValueError):
+        tiles.PrefetchJob(cache, (-10, -10, 10, 10), range(0, tiles.MAX_ZOOM + 1))
+    response = client.post('/tiles/prefetch', json={'bbox': [-10, -10, 10, 10], 'zoom': [0, 19]})
+    assert response.status_code == 400
+    assert client.post('/tiles/prefetch', json={'bbox': [1, 2, 3], 'zoom': [0, 5]}).status_code == 400
+    assert client.post('/tiles/prefetch', json={'zoom': [0, 5]}).status_code == 400
+    assert StandInTiles.requests == []
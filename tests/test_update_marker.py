@@ -0,0 +1,40 @@
+# /update_marker pose deltas across a change of the selected vehicle
+import pytest
+import geospatial
+import map_server
+from shared_data import shared_data, DEFAULT_STATE
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(shared_data, 'vehicles', {})
+    monkeypatch.setattr(shared_data, 'tracks', {})
+    monkeypatch.setattr(shared_data, 'active_vehicle', None)
+    monkeypatch.setattr(shared_data, 'state', DEFAULT_STATE)
+    monkeypatch.setattr(map_server, 'pose_cache', map_server.VersionedFields())
+    return map_server.app.test_client()
+
+def fly(vehicle, lat, lon):
+    shared_data.publish(vehicle, got_gps=True, pos_uav=geospatial.GPSposition(lat, lon, 100))
+
+
+def test_unchanged_is_304(client):
+    fly('a', 36.50, -83.20)
+    first = client.get('/update_marker')
+    assert first.json['latitude'] == 36.50
+    assert client.get('/update_marker', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+def test_select_older_vehicle(client):
+    fly('a', 36.50, -83.20)
+    fly('b', 36.60, -83.30)
+    # a is active, the client catches up with its newest pose
+    for lat in (36.51, 36.52):
+        fly('a', lat, -83.20)
+    cursor = client.get('/update_marker').json['pose_seq']
+    assert cursor > shared_data.vehicles['b'].seq
+    # b's last state is older than the client's cursor, it must still be sent
+    client.post('/select_vehicle', json={'vehicle': 'b'})
+    response = client.get(f'/update_marker?pose={cursor}&markers=-1')
+    assert response.status_code == 200
+    assert (response.json['latitude'], response.json['longitude']) == (36.60, -83.30)
+    assert response.json['pose_seq'] > cursor
@@ -0,0 +1,280 @@
+# tiles.py
+# Offline map tiles: an MBTiles (SQLite) store filled from the upstream tile
+# server as tiles are viewed, or ahead of a mission with prefetch(). The most
+# used tiles are also kept in memory.
+import collections
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from shared_data import shared_data
+
+USER_AGENT = "minimgcs/0.1 (+https://github.com/xznhj8129/minimgcs)" # tile servers reject anonymous clients
+MAX_ZOOM = 19
+MAX_PREFETCH_TILES = 100000 # about 1.5 GB of OSM tiles
+
+
+class TileStore():
+    # MBTiles keeps rows in TMS order (y counted from the south), x/y here are
+    # the XYZ numbers Leaflet asks for
+    def __init__(self, path, memory_tiles=512):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                        "tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        self.db.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)",
+                            [('name', 'minimgcs'), ('format', 'png'), ('type', 'baselayer')])
+        self.db.commit()
+        self.memory = collections.OrderedDict()
+        self.memory_tiles = memory_tiles
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_tiles:
+            self.memory.popitem(last=False)
+
+    def get(self, z, x, y):
+        key = (z, x, y)
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return data
+            row = self.db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                  (z, x, (1 << z) - 1 - y)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            data = bytes(row[0])
+            self.remember(key, data)
+            self.hits += 1
+            return data
+
+    def contains(self, z, x, y):
+        with self.lock:
+            if (z, x, y) in self.memory:
+                return True
+            return self.db.execute("SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                   (z, x, (1 << z) - 1 - y)).fetchone() is not None
+
+    def put(self, z, x, y, data, remember=True):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, (1 << z) - 1 - y, sqlite3.Binary(data)))
+            self.db.commit()
+            if remember:
+                self.remember((z, x, y), data)
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        return {'tiles': count, 'memory': len(self.memory), 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def fetch_tile(url_template, z, x, y, timeout=10):
+    url = url_template.format(z=z, x=x, y=y, s="abc"[(x + y) % 3])
+    with urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': USER_AGENT}), timeout=timeout) as response:
+        return response.read()
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 1 << z and 0 <= y < 1 << z
+
+def lonlat_to_tile(lon, lat, z):
+    lat = max(-85.05112878, min(85.05112878, lat))
+    n = 1 << z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def check_bbox(bbox, zooms):
+    # ValueError unless bbox is (west, south, east, north) and zooms a range of valid zooms
+    if len(bbox) != 4:
+        raise ValueError("bbox must be [west, south, east, north]")
+    west, south, east, north = (float(v) for v in bbox)
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError("bbox must be [west, south, east, north] with west < east and south < north")
+    if not len(zooms) or zooms[0] < 0 or zooms[-1] > MAX_ZOOM:
+        raise ValueError(f"zoom must be within 0 and {MAX_ZOOM}")
+    return west, south, east, north
+
+def count_tiles_in_bbox(west, south, east, north, zooms):
+    count = 0
+    for z in zooms:
+        x0, y0 = lonlat_to_tile(west, north, z)
+        x1, y1 = lonlat_to_tile(east, south, z)
+        count += (x1 - x0 + 1) * (y1 - y0 + 1)
+    return count
+
+def tiles_in_bbox(west, south, east, north, zooms):
+    # Yields (z, x, y) covering the box at every zoom in zooms
+    for z in zooms:
+        x0, y0 = lonlat_to_tile(west, north, z)
+        x1, y1 = lonlat_to_tile(east, south, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+class TileCache():
+    # What the /tiles route uses: store first, upstream on a miss unless offline
+    def __init__(self, store, url_template):
+        self.store = store
+        self.url_template = url_template
+        self.upstream_errors = 0
+        self.upstream_down_until = 0.0
+        self.prefetch_job = None
+
+    def upstream_down(self):
+        return time.time() < self.upstream_down_until
+
+    def fetch(self, z, x, y):
+        # From upstream, None on failure. When it can't be reached at all it is
+        # left alone for tile_backoff seconds, so misses are answered at once
+        # instead of each holding a server thread for the connect timeout.
+        if shared_data.tiles_offline or self.upstream_down():
+            return None
+        try:
+            return fetch_tile(self.url_template, z, x, y)
+        except urllib.error.HTTPError:
+            # The server answered, just not with this tile
+            self.upstream_errors += 1
+        except OSError:
+            self.upstream_errors += 1
+            self.upstream_down_until = time.time() + shared_data.tile_backoff
+        return None
+
+    def tile(self, z, x, y):
+        data = self.store.get(z, x, y)
+        if data is not None:
+            return data
+        data = self.fetch(z, x, y)
+        if data is not None:
+            self.store.put(z, x, y, data)
+        return data
+
+    def prefetch(self, bbox, zooms, delay=0.0):
+        # bbox is (west, south, east, north), runs on its own thread, see PrefetchJob
+        job = PrefetchJob(self, bbox, zooms, delay)
+        if self.prefetch_job is not None and self.prefetch_job.running:
+            self.prefetch_job.stop()
+        self.prefetch_job = job
+        self.prefetch_job.start()
+        return self.prefetch_job
+
+    def stats(self):
+        stats = self.store.stats()
+        stats['upstream_errors'] = self.upstream_errors
+        stats['offline'] = shared_data.tiles_offline
+        stats['upstream_down'] = self.upstream_down()
+        if self.prefetch_job is not None:
+            stats['prefetch'] = self.prefetch_job.stats()
+        return stats
+
+
+class PrefetchJob():
+    # Downloads every missing tile in a box and zoom range, pausing while the
+    # upstream is backed off (see TileCache.fetch). delay is the pause
+    # between downloads, be kind to the public OSM servers.
+    def __init__(self, cache, bbox, zooms, delay=0.0):
+        # ValueError for a bad box or one over MAX_PREFETCH_TILES
+        bbox = check_bbox(bbox, zooms)
+        count = count_tiles_in_bbox(*bbox, zooms)
+        if count > MAX_PREFETCH_TILES:
+            raise ValueError(f"{count} tiles, more than {MAX_PREFETCH_TILES}: use a smaller box or lower zoom")
+        self.cache = cache
+        self.tiles = list(tiles_in_bbox(*bbox, zooms))
+        self.delay = delay
+        self.done = 0
+        self.fetched = 0
+        self.failed = 0
+        self.running = False
+        self.waiting = False # for the upstream to come back after a backoff
+        self.stopped = False
+
+    def ended(self):
+        return self.stopped or shared_data.tiles_offline
+
+    def fetch(self, z, x, y):
+        # Sleeps out a backoff of the cache and then tries the tile again. None
+        # when it failed, or when the job ended while waiting.
+        while not self.ended():
+            if self.cache.upstream_down():
+                self.waiting = True
+                time.sleep(min(1.0, max(0.0, self.cache.upstream_down_until - time.time())))
+                continue
+            self.waiting = False
+            data = self.cache.fetch(z, x, y)
+            if data is not None or not self.cache.upstream_down():
+                return data
+        return None
+
+    def run(self):
+        self.running = True
+        store = self.cache.store
+        for z, x, y in self.tiles:
+            if self.ended():
+                break
+            if not store.contains(z, x, y):
+                data = self.fetch(z, x, y)
+                if data is None:
+                    if self.ended():
+                        break
+                    self.failed += 1
+                else:
+                    # Kept out of the memory LRU, a big prefetch would flush the tiles in view
+                    store.put(z, x, y, data, remember=False)
+                    self.fetched += 1
+                if self.delay:
+                    time.sleep(self.delay)
+            self.done += 1
+        self.waiting = False
+        self.running = False
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped = True
+
+    def stats(self):
+        return {'total': len(self.tiles), 'done': self.done, 'fetched': self.fetched,
+                'failed': self.failed, 'running': self.running, 'waiting': self.waiting}
+
+
+tile_cache = None
+
+def get_tile_cache():
+    global tile_cache
+    if tile_cache is None:
+        tile_cache = TileCache(TileStore(shared_data.tile_cache_path, shared_data.tile_memory_cache), shared_data.tile_url)
+    return tile_cache
+
+if __name__ == '__main__':
+    # Fill the store before a mission: python tiles.py -83.25 36.50 -83.18 36.56 --zoom 10 17
+    import argparse
+    parser = argparse.ArgumentParser(description="Prefetch map tiles into the offline store")
+    parser.add_argument("bbox", type=float, nargs=4, metavar=("WEST", "SOUTH", "EAST", "NORTH"))
+    parser.add_argument("--zoom", type=int, nargs=2, default=(10, 16), metavar=("MIN", "MAX"))
+    parser.add_argument("--delay", type=float, default=0.1)
+    args = parser.parse_args()
+    job = PrefetchJob(get_tile_cache(), args.bbox, range(args.zoom[0], args.zoom[1] + 1), args.delay)
+    print(f"{len(job.tiles)} tiles")
+    job.run()
+    print(job.stats())
@@ -0,0 +1,125 @@
+# track.py
+# Flight track served at a level of detail matched to the map zoom.
+#
+# The raw track (shared_data.log_pos) is split into fixed size chunks. A
+# finished chunk never changes, so its simplified version per zoom level is
+# computed once and cached; only the open tail chunk is simplified again as
+# points arrive. Each chunk starts with the last point of the one before so
+# the simplified pieces join up.
+import math
+import threading
+
+EARTH_RADIUS = 6371008.8
+CHUNK_SIZE = 256
+MAX_ZOOM = 20
+PIXEL_TOLERANCE = 1.5 # allowed deviation in screen pixels
+
+
+def zoom_tolerance(zoom, lat):
+    # Web mercator ground resolution at this zoom and latitude, times the pixel tolerance
+    return PIXEL_TOLERANCE * 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+def douglas_peucker(points, tolerance):
+    # points: list of (lat, lon), returns the kept subset. Distances are
+    # measured on a local equirectangular projection, fine for track sized extents.
+    n = len(points)
+    if n < 3:
+        return list(points)
+    lat0 = points[0][0]
+    kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat0))
+    ky = math.radians(1) * EARTH_RADIUS
+    xy = [(p[1] * kx, p[0] * ky) for p in points]
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    tol2 = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xy[first]
+        x2, y2 = xy[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        seg2 = dx * dx + dy * dy
+        worst = -1.0
+        index = first
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            # distance to the segment, not the line through it, so out and back legs are kept
+            t = 0.0 if seg2 == 0 else min(1.0, max(0.0, ((px - x1) * dx + (py - y1) * dy) / seg2))
+            d2 = (x1 + t * dx - px) ** 2 + (y1 + t * dy - py) ** 2
+            if d2 > worst:
+                worst = d2
+                index = i
+        if worst > tol2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+class TrackChunk():
+    def __init__(self, points):
+        self.points = points
+        self.levels = {}
+        self.bbox = None
+
+    def finish(self):
+        lats = [p[0] for p in self.points]
+        lons = [p[1] for p in self.points]
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+
+    def simplified(self, zoom):
+        level = self.levels.get(zoom)
+        if level is None:
+            level = douglas_peucker(self.points, zoom_tolerance(zoom, self.points[0][0]))
+            if self.bbox is not None: # only finished chunks are cached
+                self.levels[zoom] = level
+        return level
+
+    def intersects(self, bbox):
+        if self.bbox is None:
+            lats = [p[0] for p in self.points]
+            lons = [p[1] for p in self.points]
+            box = (min(lons), min(lats), max(lons), max(lats))
+        else:
+            box = self.bbox
+        return not (box[2] < bbox[0] or box[0] > bbox[2] or box[3] < bbox[1] or box[1] > bbox[3])
+
+
+class FlightTrack():
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.count = 0 # raw points taken in
+
+    def sync(self, positions):
+        # Takes in the positions appended since the last call
+        with self.lock:
+            for pos in positions[self.count:]:
+                point = (pos.lat, pos.lon)
+                if not self.chunks or len(self.chunks[-1].points) >= self.chunk_size:
+                    if self.chunks:
+                        self.chunks[-1].finish()
+                        start = [self.chunks[-1].points[-1]]
+                    else:
+                        start = []
+                    self.chunks.append(TrackChunk(start))
+                self.chunks[-1].points.append(point)
+                self.count += 1
+
+    def query(self, zoom, bbox=None, from_chunk=0):
+        # Simplified points per chunk from from_chunk on. Chunks below
+        # 'finished' won't change again, the client only needs to refetch from there.
+        zoom = max(0, min(MAX_ZOOM, int(zoom)))
+        with self.lock:
+            chunks = []
+            for index in range(max(0, from_chunk), len(self.chunks)):
+                chunk = self.chunks[index]
+                if bbox is not None and not chunk.intersects(bbox):
+                    points = []
+                else:
+                    points = chunk.simplified(zoom)
+                chunks.append({'index': index, 'points': points})
+            finished = max(0, len(self.chunks) - 1)
+            return {'zoom': zoom, 'count': self.count, 'finished': finished, 'chunks': chunks}
@@ -0,0 +1,269 @@
+# transport.py
+# Runs any number of CRSF byte sources (serial, UDP, TCP, file) in a single
+# asyncio loop, each with its own framer, all feeding the same decoder
+import abc
+import asyncio
+import os
+import threading
+import time
+import serial
+from shared_data import shared_data, DEFAULT_VEHICLE
+from telemetry import CrsfFramer, crsf_crc_error, handleCrsfPacket, serial_read_blocking
+
+
+class CrsfSource(abc.ABC):
+    # Base of the sources, subclasses implement run()
+    kind = "source"
+
+    def __init__(self, source_id=None, retry_delay=2.0, vehicle_id=None):
+        self.source_id = source_id
+        self.vehicle_id = vehicle_id # vehicle the frames belong to, defaults to the one shared by all links
+        self.retry_delay = retry_delay
+        self.framer = CrsfFramer(on_error=crsf_crc_error)
+        self.hub = None
+        self.connected = False
+        self.reconnects = 0
+        self.last_rx = 0
+
+    def __str__(self):
+        return f"{self.source_id} ({self.kind})"
+
+    def stats(self):
+        s = self.framer.stats()
+        s['connected'] = self.connected
+        s['reconnects'] = self.reconnects
+        s['last_rx'] = self.last_rx
+        return s
+
+    def data_received(self, data):
+        # Everything completed by this chunk arrived now
+        timestamp = time.time()
+        self.last_rx = timestamp
+        for frame in self.framer.feed(data):
+            self.hub.on_frame(self, frame, timestamp)
+
+    def disconnected(self):
+        # A frame cut off by the disconnect must not be glued to the next connection
+        self.connected = False
+        self.framer.reset()
+
+    @abc.abstractmethod
+    async def run(self):
+        # Feeds data_received() until the source ends or the task is cancelled
+        pass
+
+
+class SerialSource(CrsfSource):
+    kind = "serial"
+
+    def __init__(self, port, baud=420000, **kwargs):
+        super().__init__(**kwargs)
+        self.port = port
+        self.baud = baud
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                ser = serial.Serial(self.port, self.baud, timeout=0)
+            except (serial.SerialException, OSError) as e:
+                print(f"{self}: {e}")
+                await asyncio.sleep(self.retry_delay)
+                continue
+            self.connected = True
+            try:
+                if os.name == 'posix':
+                    await self.read_fd(loop, ser)
+                else:
+                    # No add_reader for serial ports on Windows, block in the default executor
+                    ser.timeout = 1
+                    while True:
+                        data = await loop.run_in_executor(None, serial_read_blocking, ser)
+                        if data:
+                            self.data_received(data)
+            except (serial.SerialException, OSError) as e:
+                # A USB adapter pulled out raises a plain OSError (EIO, ENXIO)
+                print(f"{self}: {e}")
+            finally:
+                ser.close()
+                self.disconnected()
+            self.reconnects += 1
+            await asyncio.sleep(self.retry_delay)
+
+    async def read_fd(self, loop, ser):
+        # Wake up only when the port file descriptor is readable
+        closed = loop.create_future()
+
+        def readable():
+            try:
+                data = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                loop.remove_reader(ser.fileno())
+                if not closed.done():
+                    closed.set_exception(e)
+                return
+            if data:
+                self.data_received(data)
+
+        loop.add_reader(ser.fileno(), readable)
+        try:
+            await closed
+        finally:
+            if not ser.closed:
+                loop.remove_reader(ser.fileno())
+
+
+class UdpSource(CrsfSource, asyncio.DatagramProtocol):
+    # e.g. ELRS backpack / WiFi bridge sending raw CRSF in datagrams
+    kind = "udp"
+
+    def __init__(self, host="0.0.0.0", port=14550, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+
+    def datagram_received(self, data, addr):
+        self.data_received(data)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.connected = True
+        try:
+            await loop.create_future()
+        finally:
+            transport.close()
+            self.disconnected()
+
+
+class TcpSource(CrsfSource):
+    kind = "tcp"
+
+    def __init__(self, host, port, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                print(f"{self}: {e}")
+                await asyncio.sleep(self.retry_delay)
+                continue
+            self.connected = True
+            try:
+                while True:
+                    data = await reader.read(4096)
+                    if not data:
+                        break
+                    self.data_received(data)
+            except OSError as e:
+                print(f"{self}: {e}")
+            finally:
+                writer.close()
+                self.disconnected()
+            self.reconnects += 1
+            await asyncio.sleep(self.retry_delay)
+
+
+class FileSource(CrsfSource):
+    # Raw byte capture, fed as fast as the loop allows
+    kind = "file"
+
+    def __init__(self, path, chunk_size=4096, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.chunk_size = chunk_size
+
+    async def run(self):
+        with open(self.path, 'rb') as f:
+            self.connected = True
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                self.data_received(data)
+                await asyncio.sleep(0) # let the other sources run
+        self.disconnected()
+
+
+class TelemetryHub():
+    def __init__(self, sources=()):
+        self.sources = []
+        self.loop = None
+        for source in sources:
+            self.add_source(source)
+
+    def add_source(self, source):
+        source.hub = self
+        if source.source_id is None:
+            source.source_id = f"{source.kind}{len(self.sources)}"
+        if source.vehicle_id is None:
+            # Links are redundant paths to one aircraft unless a vehicle is named
+            source.vehicle_id = DEFAULT_VEHICLE
+        self.sources.append(source)
+        return source
+
+    def on_frame(self, source, frame, timestamp):
+        if shared_data.recorder is not None:
+            shared_data.recorder.record(timestamp, source.source_id, frame)
+        handleCrsfPacket(frame[2], frame, timestamp, source.vehicle_id)
+
+    def stats(self):
+        return {source.source_id: source.stats() for source in self.sources}
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(source.run() for source in self.sources), return_exceptions=True)
+        for source, result in zip(self.sources, results):
+            if isinstance(result, Exception):
+                print(f"{source}: stopped: {result}")
+
+    def start(self):
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        thread.start()
+        return thread
+
+
+def host_port(rest, default_port):
+    # "host:port", "host" or just "port" (all interfaces)
+    if rest.isdigit():
+        return "0.0.0.0", int(rest)
+    host, sep, port = rest.rpartition(':')
+    if not sep:
+        return rest or "0.0.0.0", default_port
+    return host or "0.0.0.0", int(port)
+
+def source_from_url(url):
+    # serial:/dev/ttyACM0:420000  udp:0.0.0.0:14550  tcp:192.168.4.1:5761  file:capture.bin
+    # An optional "name=" prefix sets the source id: backpack=udp:0.0.0.0:14550
+    # All sources feed the same vehicle unless one is given after an @, for
+    # several aircraft: rx2@wing1=serial:/dev/ttyUSB1
+    source_id = vehicle_id = None
+    if '=' in url.split(':', 1)[0]:
+        source_id, url = url.split('=', 1)
+        source_id, _, vehicle_id = source_id.partition('@')
+        vehicle_id = vehicle_id or None
+    kind, _, rest = url.partition(':')
+    if kind == "serial":
+        port, _, baud = rest.rpartition(':')
+        if port and baud.isdigit():
+            return SerialSource(port, int(baud), source_id=source_id, vehicle_id=vehicle_id)
+        return SerialSource(rest, shared_data.telem_baud, source_id=source_id, vehicle_id=vehicle_id)
+    elif kind == "udp":
+        host, port = host_port(rest, 14550)
+        return UdpSource(host, port, source_id=source_id, vehicle_id=vehicle_id)
+    elif kind == "tcp":
+        host, port = host_port(rest, 5761)
+        return TcpSource(host, port, source_id=source_id, vehicle_id=vehicle_id)
+    elif kind == "file":
+        return FileSource(rest, source_id=source_id, vehicle_id=vehicle_id)
+    raise ValueError(f"Unknown telemetry source: {url}")
+
+def start_telemetry_hub(urls):
+    hub = TelemetryHub([source_from_url(url) for url in urls])
+    shared_data.telemetry_hub = hub
+    hub.start()
+    return hub
@@ -7,6 +7,7 @@ def keyPressEvent(app, event):
         shared_data.video_select = False
         shared_data.video_track_zoom_active = False
         shared_data.video_track_zoom_level = 1.0
+        app.update_button_color()
         print("Key C pressed")
         
     elif event.key() == Qt.Key_D: